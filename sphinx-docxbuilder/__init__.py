@@ -12,4 +12,12 @@ def setup(app):
     app.add_config_value('docx_descriptions', 'This document generaged by sphix-docxbuilder', 'env')
     app.add_config_value('docx_keywords', ['python', 'Office Open XML', 'Word'] , 'env')
     app.add_config_value('docx_coverpage', True, 'env')
+    app.add_config_value('docx_cache_fragments', False, '')
+    app.add_config_value('docx_parallel', 1, '')
+    app.add_config_value('docx_split', '', 'env')
+    app.add_config_value('docx_streaming', False, '')
+    app.add_config_value('docx_compression', 'default', '')
+    app.add_config_value('docx_coalesce_runs', False, '')
+    app.add_config_value('docx_image_dpi', 0, 'env')
+    app.add_config_value('docx_image_quality', 85, 'env')
 
@@ -10,17 +10,40 @@
     :license: BSD, see LICENSE for details.
 """
 
+import os
 import codecs
+import multiprocessing
+import cPickle as pickle
 from os import path
+from hashlib import md5
 
 from docutils import nodes
 from docutils.io import StringOutput
 
 from sphinx.builders import Builder
+from sphinx.errors import ConfigError
 from sphinx.util.osutil import ensuredir, os_path
 from sphinx.util.nodes import inline_all_toctrees
 from sphinx.util.console import bold, darkgreen, brown
 from writer import DocxWriter
+from cache import FragmentCache
+import docx
+
+
+FINGERPRINT_FILENAME = 'docx.fingerprints'
+FRAGMENT_CACHE_DIRNAME = 'docx-fragments'
+TEMPLATE_CACHE_DIRNAME = 'docx-templates'
+IMAGE_INFO_FILENAME = 'docx-images.pickle'
+IMAGE_CACHE_DIRNAME = 'docx-images'
+# The values of docx_split, but '' for one .docx file.
+SPLIT_MODES = ('document', 'toplevel')
+# The settings which change how fast the output is made, not the output.
+PERFORMANCE_SETTINGS = ('docx_cache_fragments', 'docx_parallel',
+                        'docx_streaming', 'docx_compression')
+
+#  The split output is written by worker processes forked from the
+#  builder, they find it in '_split_context'.
+_split_context = None
 
 
 class DocxBuilder(Builder):
@@ -29,13 +52,142 @@ class DocxBuilder(Builder):
     out_suffix = '.docx'
 
     def init(self):
-        pass
+        if self.config.docx_split and \
+               self.config.docx_split not in SPLIT_MODES:
+            raise ConfigError('docx_split must be %s or empty, not %r' %
+                              (' or '.join(["'%s'" % x for x in SPLIT_MODES]),
+                               self.config.docx_split))
+        self.fingerprints = self.load_fingerprints()
+        self.fragment_cache = None
+        self.template = None
+        self.image_infos = None
+        self.image_resampler = None
+        self.docx_docnames = None
+
+    def get_outfilename(self):
+        if self.config.docx_split:
+            docname = self.config.master_doc
+        else:
+            docname = "%s-%s" % (self.config.project, self.config.version)
+        return path.join(self.outdir, os_path(docname) + self.out_suffix)
+
+    def get_style_filename(self):
+        return docx.find_file(self.config.docx_style or 'style.docx',
+                              'sphinx-docxbuilder/docx')
+
+    def get_config_fingerprint(self):
+        '''
+           Digest of everything outside the sources that affects the output:
+           the docx_* settings (but PERFORMANCE_SETTINGS) and the contents
+           of the style file.
+        '''
+        digest = md5('fragments=%d\n' % docx.FRAGMENT_VERSION)
+        for name in sorted(self.config.values):
+            if name in PERFORMANCE_SETTINGS:
+                continue
+            if name.startswith('docx_') or name in ('project', 'version',
+                    'master_doc', 'pygments_style', 'trim_doctest_flags'):
+                digest.update('%s=%r\n' % (name, self.config[name]))
+        stylefile = self.get_style_filename()
+        if stylefile:
+            f = open(stylefile, 'rb')
+            digest.update(f.read())
+            f.close()
+        return digest.hexdigest()
+
+    def get_doc_fingerprint(self, docname):
+        '''
+           Fingerprint of a document: a digest of its pickled doctree and
+           of the size and mtime of the files it depends on (included
+           files, images).  Changed sources are picked up by the
+           environment itself, this catches doctrees re-read by another
+           builder sharing doctreedir, and dependencies whose change
+           leaves the doctree as it was.
+        '''
+        try:
+            f = open(path.join(self.doctreedir, os_path(docname) + '.doctree'), 'rb')
+            try:
+                digest = md5(f.read())
+            finally:
+                f.close()
+        except (IOError, OSError):
+            return None
+        deps = set(self.env.dependencies.get(docname, ()))
+        for imgpath, (docs, uniquename) in self.env.images.iteritems():
+            if docname in docs:
+                deps.add(imgpath)
+        for dep in sorted(deps):
+            try:
+                st = os.stat(path.join(self.srcdir, dep))
+                digest.update('%s %r %d\n' % (dep, st.st_mtime, st.st_size))
+            except OSError:
+                digest.update('%s missing\n' % dep)
+        return digest.hexdigest()
+
+    def load_fingerprints(self):
+        try:
+            f = open(path.join(self.doctreedir, FINGERPRINT_FILENAME), 'rb')
+            try:
+                return pickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            return {'config': None, 'docs': {}}
+
+    def save_fingerprints(self, fingerprints):
+        try:
+            f = open(path.join(self.doctreedir, FINGERPRINT_FILENAME), 'wb')
+            pickle.dump(fingerprints, f, pickle.HIGHEST_PROTOCOL)
+            f.close()
+        except (IOError, OSError), err:
+            self.warn("error writing file %s: %s" % (FINGERPRINT_FILENAME, err))
+        self.fingerprints = fingerprints
+
+    def collect_fingerprints(self):
+        docs = {}
+        for docname in self.env.found_docs:
+            docs[docname] = self.get_doc_fingerprint(docname)
+        return {'config': self.get_config_fingerprint(), 'docs': docs}
 
     def get_outdated_docs(self):
-        return 'pass'
+        old = self.fingerprints
+        if not path.isfile(self.get_outfilename()) or \
+               old['config'] != self.get_config_fingerprint():
+            for docname in self.env.found_docs:
+                yield docname
+            return
+        for docname in self.env.found_docs:
+            fingerprint = old['docs'].get(docname)
+            if fingerprint is None or \
+                   fingerprint != self.get_doc_fingerprint(docname):
+                yield docname
+
+    def get_docx_docnames(self):
+        '''
+           Map each document to the document whose .docx file contains it
+           in the split output.
+        '''
+        master = self.config.master_doc
+        result = dict((x, x) for x in self.env.found_docs)
+        if self.config.docx_split == 'toplevel':
+            def include(docname, toplevel):
+                if result.get(docname) == toplevel:
+                    return
+                result[docname] = toplevel
+                for x in self.env.toctree_includes.get(docname, []):
+                    include(x, toplevel)
+            for docname in result:
+                result[docname] = master
+            for docname in self.env.toctree_includes.get(master, []):
+                include(docname, docname)
+        return result
 
     def get_target_uri(self, docname, typ=None):
-        return ''
+        if not self.config.docx_split:
+            return ''
+        if self.docx_docnames is None:
+            self.docx_docnames = self.get_docx_docnames()
+        return self.docx_docnames.get(docname, docname) + self.out_suffix
 
     def fix_refuris(self, tree):
         # fix refuris with double anchor
@@ -52,7 +204,36 @@ class DocxBuilder(Builder):
                 refnode['refuri'] = fname + refuri[hashindex:]
 
     def prepare_writing(self, docnames):
-        self.writer = DocxWriter(self)
+        try:
+            docx.get_compression_levels(self.config.docx_compression)
+        except ValueError, err:
+            raise ConfigError('docx_compression: %s' % err)
+        if self.config.docx_cache_fragments:
+            self.fragment_cache = FragmentCache(
+                    path.join(self.doctreedir, FRAGMENT_CACHE_DIRNAME),
+                    self.get_config_fingerprint())
+        elif self.config.docx_parallel > 1:
+            # keys only, to match the fragments of the worker processes
+            self.fragment_cache = FragmentCache(None,
+                    self.get_config_fingerprint())
+        # the size of the images, kept for the next builds
+        self.image_infos = docx.ImageInfoCache(
+                path.join(self.doctreedir, IMAGE_INFO_FILENAME))
+        if self.config.docx_image_dpi:
+            self.image_resampler = docx.ImageResampler(
+                    path.join(self.doctreedir, IMAGE_CACHE_DIRNAME),
+                    self.config.docx_image_dpi,
+                    self.config.docx_image_quality,
+                    self.config.docx_parallel)
+        # read once, every composer works on a copy of it
+        stylefile = self.get_style_filename()
+        if stylefile:
+            self.template = docx.get_template(stylefile,
+                    path.join(self.doctreedir, TEMPLATE_CACHE_DIRNAME))
+        if self.config.docx_split:
+            self.docx_docnames = self.get_docx_docnames()
+        else:
+            self.writer = DocxWriter(self)
 
     def assemble_doctree(self):
         master = self.config.master_doc
@@ -63,19 +244,95 @@ class DocxBuilder(Builder):
         self.fix_refuris(tree)
         return tree
 
-    def write(self, *ignored):
+    def assemble_split_doctree(self, docname):
+        '''
+           The doctree of one .docx file of the split output: 'docname'
+           with the documents it includes, and its toctrees resolved to
+           links if it doesn't include them.
+        '''
+        if self.config.docx_split == 'toplevel' and \
+               docname != self.config.master_doc:
+            tree = self.env.get_doctree(docname)
+            tree = inline_all_toctrees(self, set(), docname, tree, darkgreen)
+            tree['docname'] = docname
+            self.env.resolve_references(tree, docname, self)
+            return tree
+        return self.env.get_and_resolve_doctree(docname, self)
+
+    def get_split_docnames(self):
+        return sorted(set(self.docx_docnames.values()))
+
+    def write_split_doc(self, docname):
+        self.writer = DocxWriter(self)
+        return self.write_doc(docname, self.assemble_split_doctree(docname))
+
+    def write_split(self):
+        '''
+           Write one .docx file per document or top-level document, in
+           worker processes if 'docx_parallel' allows.
+        '''
+        global _split_context
+        docnames = self.get_split_docnames()
+        processes = self.config.docx_parallel
+        results = [None] * len(docnames)
+        if processes > 1 and len(docnames) > 1 and hasattr(os, 'fork'):
+            _split_context = (self, docnames)
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_write_split_doc, range(len(docnames)), 1)
+            finally:
+                pool.close()
+                pool.join()
+                _split_context = None
+
+        success = True
+        for docname, result in zip(docnames, results):
+            self.info(darkgreen(docname) + ' ', nonl=True)
+            if result is None:
+                # not written by a worker, or the worker failed
+                result = self.write_split_doc(docname), [], [], {}
+            if self.fragment_cache is not None:
+                self.fragment_cache.used.update(result[1])
+            if self.image_resampler is not None:
+                self.image_resampler.used.update(result[2])
+            self.image_infos.update(result[3])
+            success = success and result[0]
+        return success
+
+    def write(self, build_docnames, updated_docnames, method='update'):
         docnames = self.env.all_docs
 
+        fingerprints = self.collect_fingerprints()
+        if method == 'update' and not updated_docnames and \
+               fingerprints == self.fingerprints and \
+               path.isfile(self.get_outfilename()):
+            self.info(bold('no documents changed, keeping %s' %
+                           path.basename(self.get_outfilename())))
+            return
+
         self.info(bold('preparing documents... '), nonl=True)
         self.prepare_writing(docnames)
         self.info('done')
 
-        self.info(bold('assembling single document... '), nonl=True)
-        doctree = self.assemble_doctree()
-        self.info()
-        self.info(bold('writing... '), nonl=True)
-        docname = "%s-%s" % (self.config.project, self.config.version)
-        self.write_doc(docname, doctree)
+        if self.config.docx_split:
+            self.info(bold('writing split documents... '), nonl=True)
+            success = self.write_split()
+        else:
+            self.info(bold('assembling single document... '), nonl=True)
+            doctree = self.assemble_doctree()
+            self.info()
+            self.info(bold('writing... '), nonl=True)
+            docname = "%s-%s" % (self.config.project, self.config.version)
+            success = self.write_doc(docname, doctree)
+        if success:
+            self.save_fingerprints(fingerprints)
+            if self.fragment_cache is not None:
+                self.fragment_cache.prune()
+        self.image_infos.save()
+        if self.image_resampler is not None:
+            self.image_resampler.close()
+            if success:
+                self.image_resampler.prune()
         self.info('done')
 
     def write_doc(self, docname, doctree):
@@ -88,7 +345,28 @@ class DocxBuilder(Builder):
             self.writer.save(outfilename)
         except (IOError, OSError), err:
             self.warn("error writing file %s: %s" % (outfilename, err))
+            return False
+        return True
 
     def finish(self):
         #self.warn("call finish")
         pass
+
+
+def _write_split_doc(index):
+    '''
+       Worker: write one .docx file of the split output.  Return None on
+       failure, the file is then written by the builder itself.
+    '''
+    builder, docnames = _split_context
+    try:
+        success = builder.write_split_doc(docnames[index])
+    except Exception:
+        return None
+    used = []
+    if builder.fragment_cache is not None:
+        used = list(builder.fragment_cache.used)
+    images = []
+    if builder.image_resampler is not None:
+        images = list(builder.image_resampler.used)
+    return success, used, images, builder.image_infos.get_changes()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxcontrib-docxbuilder cache
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    On-disk cache of the rendered WordprocessingML of included documents,
+    so that unchanged chapters don't have to be translated again.  The
+    parallel writer uses the same fragments to merge the output of its
+    worker processes.
+
+    :copyright:
+        Copyright 2010 by shimizukawa at gmail dot com (Sphinx-users.jp).
+    :license: BSD, see LICENSE for details.
+"""
+
+import os
+import cPickle as pickle
+from os import path
+from hashlib import md5
+
+
+class FragmentCache(object):
+    '''
+       Fragments are stored as pickles named after their key.  The key is
+       a digest of the 'salt' (the configuration fingerprint of the build)
+       and whatever the translator passes to make_key().  Without a
+       'cachedir' nothing is stored, only the keys are made.
+    '''
+    def __init__(self, cachedir=None, salt=''):
+        self.cachedir = cachedir
+        self.salt = salt
+        self.used = set()
+        if cachedir and not path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+    def make_key(self, *parts):
+        digest = md5(self.salt)
+        for part in parts:
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            digest.update(str(part))
+            digest.update('\0')
+        return digest.hexdigest()
+
+    def get_filename(self, key):
+        return path.join(self.cachedir, key + '.pickle')
+
+    def has(self, key):
+        return bool(self.cachedir) and path.isfile(self.get_filename(key))
+
+    def get(self, key):
+        self.used.add(key)
+        if not self.cachedir:
+            return None
+        try:
+            f = open(self.get_filename(key), 'rb')
+            try:
+                return pickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            return None
+
+    def put(self, key, fragment):
+        self.used.add(key)
+        if not self.cachedir:
+            return
+        try:
+            f = open(self.get_filename(key), 'wb')
+            try:
+                pickle.dump(fragment, f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+        except (IOError, OSError):
+            pass
+
+    def prune(self):
+        '''
+           Remove the fragments which were not used by this build.
+        '''
+        if not self.cachedir:
+            return
+        for fname in os.listdir(self.cachedir):
+            key, ext = path.splitext(fname)
+            if ext == '.pickle' and key not in self.used:
+                try:
+                    os.unlink(path.join(self.cachedir, fname))
+                except OSError:
+                    pass
@@ -0,0 +1,126 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#  Microbenchmarks of the docx composer.
+#
+#    benchDocx.py elements [paragraphs]
+#      paragraphs/sec made by the trees of make_element_tree() (as they
+#      were before the element templates), and by the composer.
+#
+#    benchDocx.py xpath [items]
+#      list items and table rows/sec composed with the paths evaluated by
+#      lxml on each call (as they were before the compiled paths), and
+#      with the compiled paths.
+#
+#    benchDocx.py lists [lists]
+#      nested enumerated lists/sec, counting the items of the outer list
+#      at each nested list by a scan of the body (as it was before the
+#      index of the numbered paragraphs), and by the index.
+#
+
+import sys
+import time
+import docx
+
+def interpreted_paragraph(style, texts):
+  paragraph = docx.make_element_tree([['w:p'],
+                    [['w:pPr'],
+                        [['w:pStyle',{'w:val':style}]],
+                        [['w:ind',{'w:leftChars':'0','w:left': '0'} ]]
+                    ]
+                 ])
+  for txt in texts :
+    attr = {}
+    if txt.find(' ') != -1 :
+      attr = {'xml:space':'preserve'}
+    paragraph.append(docx.make_element_tree([['w:r'], [['w:t', txt, attr]]]))
+  return paragraph
+
+def compiled_paragraph(composer, style, texts):
+  return composer.paragraph(texts, style=style, create_only=True)
+
+def bench(name, func, n, unit='paragraphs'):
+  start = time.time()
+  for i in xrange(n) :
+    func(i)
+  elapsed = time.time() - start
+  print '%-12s %8d %s %7.2fs %10.0f %s/sec' % (name, n, unit, elapsed, n / elapsed, unit)
+
+def bench_elements(n):
+  composer = docx.DocxComposer()
+  composer.new_document('style.docx')
+  texts = ['Lorem', ' ipsum dolor sit amet, ', 'consectetur']
+  bench('interpreted', lambda i: interpreted_paragraph('BodyText', texts), n)
+  bench('compiled', lambda i: compiled_paragraph(composer, 'BodyText', texts), n)
+
+def interpreted_get_elements(xml, path, ns=docx.nsprefixes):
+  result = []
+  try:
+    result = xml.xpath(path, namespaces=ns)
+  except:
+    pass
+  return result
+
+def compose_lists_and_tables(composer, n):
+  for i in xrange(n) :
+    p = composer.paragraph(['item ', str(i)], style='ListBullet')
+    composer.insert_numbering_property(p, lvl=i % 3, nId=0)
+    composer.get_last_paragraph_style()
+    composer.set_indent(p, 400)
+
+    table = composer.insert_field_list_table()
+    composer.insert_field_list_item(table, 'name')
+    composer.get_last_field_list_body(table).append(composer.paragraph('body', create_only=True))
+    composer.get_table_cell(table, (0, 0))
+    composer.release(table)
+
+def bench_xpath(n):
+  compiled_get_elements = docx.docx.get_elements
+  for name, func in [('interpreted', interpreted_get_elements),
+                     ('compiled', compiled_get_elements)] :
+    docx.docx.get_elements = func
+    composer = docx.DocxComposer()
+    composer.new_document('style.docx')
+    bench(name, lambda i: compose_lists_and_tables(composer, 1), n, 'items')
+  docx.docx.get_elements = compiled_get_elements
+
+def scan_numbering_paragraph(composer, nId):
+  val = docx.norm_name('w:val')
+  result = 0
+  for p in composer.docbody :
+    for x in docx.get_elements(p, 'w:pPr/w:numPr/w:numId') :
+      if int(x.get(val)) == int(nId) :
+        result += 1
+  return result
+
+def indexed_numbering_paragraph(composer, nId):
+  return len(composer.find_numbering_paragraph(nId))
+
+def compose_nested_list(composer, count):
+  outer = composer.get_max_numbering_id() + 1
+  composer.list_item(['outer'], 'ListNumber', 1, outer)
+  # a nested list restarts the numbering after the outer items
+  count(composer, outer)
+  inner = composer.get_max_numbering_id() + 1
+  composer.list_item(['inner'], 'ListNumber', 2, inner)
+  composer.list_item(['inner'], 'ListNumber', 2, inner)
+  composer.list_item(['outer'], 'ListNumber', 1, outer)
+
+def bench_lists(n):
+  for name, count in [('scan', scan_numbering_paragraph),
+                      ('indexed', indexed_numbering_paragraph)] :
+    composer = docx.DocxComposer()
+    composer.new_document('style.docx')
+    bench(name, lambda i: compose_nested_list(composer, count), n, 'lists')
+
+benchmarks = {'elements':(bench_elements, 100000), 'xpath':(bench_xpath, 20000),
+              'lists':(bench_lists, 5000)}
+
+if __name__ == '__main__' :
+  if len(sys.argv) > 1 and sys.argv[1] in benchmarks :
+    func, n = benchmarks[sys.argv[1]]
+    if len(sys.argv) > 2 :
+      n = int(sys.argv[2])
+    func(n)
+  else:
+    print sys.argv[0], " <%s> [count]" % '|'.join(sorted(benchmarks))
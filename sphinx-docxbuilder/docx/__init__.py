@@ -1,2 +1,3 @@
 from docx import *
+from resample import ImageResampler
 
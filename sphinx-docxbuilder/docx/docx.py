@@ -15,15 +15,25 @@
 '''
 
 from lxml import etree
-import Image
 import zipfile
 import shutil
 import re
 import time
+import struct
+import zlib
 import os
 from os.path import join
 import tempfile
 import sys
+import copy
+import collections
+import cPickle as pickle
+from cStringIO import StringIO
+from hashlib import md5
+from functools import partial
+from itertools import izip
+from multiprocessing.pool import ThreadPool
+from imageinfo import ImageInfoCache
 
 
 # All Word prefixes / namespace matches used in document.xml & core.xml.
@@ -68,43 +78,120 @@ Enum_Types = {
     'upperroman':'upperRoman'
     }
 
+# The type of the relationships of the images
+image_relationship = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/image'
+
 #####################
+class QNames(dict):
+  '''
+     The formal expressions of the names of 'namespaces', made once by
+     name: QNames(nsprefixes)['w:val'] --> '{namespace}val'
+  '''
+  def __init__(self, namespaces):
+    dict.__init__(self)
+    self.namespaces = namespaces
+
+  def __missing__(self, tagname):
+    ns_name = tagname.split(':', 1)
+    if len(ns_name) >1 :
+      qname = "{%s}%s" % (self.namespaces[ns_name[0]], ns_name[1])
+    else:
+      qname = tagname
+    self[tagname] = qname
+    return qname
+
+class NamePrefixes(dict):
+  '''
+     The prefix of each name, if it is one of 'namespaces', or None:
+     NamePrefixes(nsprefixes)['w:val'] --> 'w'
+  '''
+  def __init__(self, namespaces):
+    dict.__init__(self)
+    self.namespaces = namespaces
+
+  def __missing__(self, tagname):
+    ns_name = tagname.split(':', 1)
+    prefix = None
+    if len(ns_name) > 1 and self.namespaces.get(ns_name[0]) :
+      prefix = ns_name[0]
+    self[tagname] = prefix
+    return prefix
+
+qnames = QNames(nsprefixes)
+name_prefixes = NamePrefixes(nsprefixes)
+
 def norm_name(tagname, namespaces=nsprefixes):
     '''
        Convert the 'tagname' to a formal expression.
           'ns:tag' --> '{namespace}tag'
           'tag' --> 'tag'
     '''
+    if namespaces is nsprefixes :
+      return qnames[tagname]
     ns_name = tagname.split(':', 1)
     if len(ns_name) >1 :
       tagname = "{%s}%s" % (namespaces[ns_name[0]], ns_name[1])
     return tagname
 
-def get_elements(xml, path, ns=nsprefixes):
+#
+#  Compiled paths of get_elements(): a list of tag names for the paths made
+#  of child steps only ('w:pPr/w:numPr'), an XPath object for the others.
+#
+_child_step = re.compile(r'^[A-Za-z_][\w.-]*:[A-Za-z_][\w.-]*$')
+_compiled_paths = {}
+
+def compile_path(path, ns=nsprefixes):
     '''
-       Get elements from a Element tree with 'path'.
+       Return the compiled 'path', from the cache if it was compiled
+       already.  An invalid path raises etree.XPathSyntaxError.
     '''
-    result = []
+    if ns is nsprefixes :
+      key = path
+    else:
+      key = (path, tuple(sorted(ns.items())))
     try:
-      result = xml.xpath(path, namespaces=ns)
-    except:
+      return _compiled_paths[key]
+    except KeyError:
       pass
+
+    steps = path.split('/')
+    if all([_child_step.match(x) and x.split(':', 1)[0] in ns for x in steps]) :
+      compiled = [norm_name(x, ns) for x in steps]
+    else:
+      compiled = etree.XPath(path, namespaces=ns)
+    _compiled_paths[key] = compiled
+    return compiled
+
+def get_elements(xml, path, ns=nsprefixes):
+    '''
+       Get elements from a Element tree with 'path'.  No element for
+       no tree ('xml' is None).
+    '''
+    if xml is None :
+      return []
+    compiled = compile_path(path, ns)
+    if not isinstance(compiled, list) :
+      return compiled(xml)
+
+    result = list(xml.iterchildren(compiled[0]))
+    for tag in compiled[1:] :
+      if not result :
+        break
+      result = [x for elem in result for x in elem.iterchildren(tag)]
     return result
 
 def append_element(elem, xml, path=None, index=0, ns=nsprefixes):
     '''
        Append an Element
     '''
-    try:
-      dist = xml
-      if path :
-        dist = xml.xpath(path, namespaces=ns)
-      dist[index].append(elem)
-      return True
-    except:
-      print "Error  in append_element"
-
-    return False
+    dist = [xml]
+    if path :
+      dist = get_elements(xml, path, ns)
+    if len(dist) <= index :
+      print "Error  in append_element: no element at", path, index
+      return False
+    dist[index].append(elem)
+    return True
 
 def find_file(filename, child_dir=None):
     '''
@@ -165,14 +252,14 @@ def extract_nsmap(tag, attributes):
     '''
     '''
     result = {}
-    ns_name = tag.split(':', 1)
-    if len(ns_name) > 1 and nsprefixes.get(ns_name[0]) :
-        result[ns_name[0]] = nsprefixes[ns_name[0]]
+    prefix = name_prefixes[tag]
+    if prefix :
+        result[prefix] = nsprefixes[prefix]
 
     for x in attributes:
-      ns_name = x.split(':', 1)
-      if len(ns_name) > 1 and nsprefixes.get(ns_name[0]) :
-          result[ns_name[0]] = nsprefixes[ns_name[0]]
+      prefix = name_prefixes[x]
+      if prefix :
+          result[prefix] = nsprefixes[prefix]
 
     return result
 
@@ -186,15 +273,15 @@ def make_element_tree(arg, _xmlns=None):
     nsmap = extract_nsmap(tagname, attributes)
 
     if _xmlns is None :
-      newele = etree.Element(norm_name(tagname), nsmap=nsmap)
+      newele = etree.Element(qnames[tagname], nsmap=nsmap)
     else :
-      newele = etree.Element(norm_name(tagname), xmlns=_xmlns, nsmap=nsmap)
+      newele = etree.Element(qnames[tagname], xmlns=_xmlns, nsmap=nsmap)
 
     if tagtext :
       newele.text = tagtext
 
     for attr in attributes:
-      newele.set(norm_name(attr), attributes[attr])
+      newele.set(qnames[attr], attributes[attr])
 
     for child in children:
       chld = make_element_tree(child)
@@ -203,6 +290,62 @@ def make_element_tree(arg, _xmlns=None):
 
     return newele
 
+class Slot(object):
+  '''
+     A placeholder for a text or an attribute value in the tree of an
+     ElementTemplate.
+  '''
+  def __init__(self, name):
+    self.name = name
+
+class ElementTemplate(object):
+  '''
+     A tree of make_element_tree() made once, with Slots in place of the
+     texts and attribute values which change: new() copies the tree and
+     fills the Slots, e.g.
+
+       tmpl = ElementTemplate([['w:pStyle', {'w:val':Slot('style')}]])
+       elem = tmpl.new(style='BodyText')
+  '''
+  def __init__(self, arg, _xmlns=None):
+    self.slots = []
+    self.prototype = make_element_tree(self.compile(arg, ()), _xmlns)
+
+  def compile(self, arg, path):
+    '''
+       Return the tree 'arg' without Slots, and collect them as
+       (name, path of the element, attribute name or None for the text).
+       The Slots of the attributes are replaced in place, which keeps the
+       order of the attributes.
+    '''
+    tag = arg[0]
+    if isinstance(tag, list) :
+      tag = list(tag)
+      for i, x in enumerate(tag[1:3]) :
+        if isinstance(x, Slot) :
+          self.slots.append((x.name, path, None))
+          tag[i+1] = ''
+        elif isinstance(x, dict) :
+          for attr in x :
+            if isinstance(x[attr], Slot) :
+              self.slots.append((x[attr].name, path, norm_name(attr)))
+              x[attr] = ''
+    children = [self.compile(child, path + (i,)) for i, child in enumerate(arg[1:])]
+    return [tag] + children
+
+  def new(self, **values):
+    elem = copy.deepcopy(self.prototype)
+    for name, path, attr in self.slots :
+      target = elem
+      for i in path :
+        target = target[i]
+      if attr is None :
+        if values[name] :
+          target.text = values[name]
+      else:
+        target.set(attr, values[name])
+    return elem
+
 def get_child_element(xml, p):
     '''
        
@@ -240,6 +383,268 @@ def get_attribute(xml, path, name):
       return None
     return elems[0].attrib[norm_name(name)]
 
+def parse_fragment(xmlstring):
+    '''
+       Parse a sequence of serialized elements, return the list of them.
+    '''
+    if not xmlstring :
+      return []
+    container = etree.fromstring('<w:body xmlns:w="%s">%s</w:body>' %
+                                    (nsprefixes['w'], xmlstring))
+    return list(container)
+
+def tostring_standalone(elem):
+    '''
+       Serialize 'elem' with the namespace declarations it uses, rather
+       than all those of its document, to be parsed into another document.
+    '''
+    elem = etree.fromstring(etree.tostring(elem))
+    etree.cleanup_namespaces(elem)
+    return etree.tostring(elem)
+
+_bookmark_name = re.compile(r'^[A-Za-z][A-Za-z0-9_]{0,39}$')
+
+def bookmark_name(anchor):
+    '''
+       The name of the bookmark of the target 'anchor'.  Word takes up to
+       40 letters, digits and underscores, the other anchors are mangled.
+    '''
+    if _bookmark_name.match(anchor) :
+      return anchor
+    name = re.sub(r'[^A-Za-z0-9_]', '_', anchor)
+    return 'ref_%s_%s' % (md5(anchor.encode('utf-8')).hexdigest()[:8], name[:27])
+
+#
+#  Compression of the members of the docx file: the deflate level by the
+#  extension of the member ('*' for the others), 0 to store the member.
+#
+COMPRESSION_PRESETS = {
+    'default':{'*':6, '.png':0, '.jpeg':0, '.jpg':0, '.gif':0},
+    'fast':{'*':1, '.png':0, '.jpeg':0, '.jpg':0, '.gif':0},
+    'store':{'*':0}
+    }
+
+def get_compression_levels(policy='default'):
+    '''
+       Return the deflate levels of a preset, or of a dictionary updating
+       the 'default' preset, e.g. {'.emf':'store', '.xml':9}.
+    '''
+    if isinstance(policy, basestring) :
+      if policy not in COMPRESSION_PRESETS :
+        raise ValueError('Compression preset "%s" not implemented. Valid presets: %s.' % (policy, sorted(COMPRESSION_PRESETS)))
+      return dict(COMPRESSION_PRESETS[policy])
+
+    if not isinstance(policy, dict) :
+      raise ValueError('Compression policy must be a preset name or a dictionary, not %r.' % (policy,))
+    levels = dict(COMPRESSION_PRESETS['default'])
+    for ext, level in policy.items() :
+      if level == 'store' :
+        level = 0
+      elif level == 'deflate' :
+        level = 6
+      try:
+        level = int(level)
+      except (TypeError, ValueError):
+        level = None
+      if level is None or not 0 <= level <= 9 :
+        raise ValueError('Invalid compression level %r for "%s": 0-9, "store" or "deflate".' % (policy[ext], ext))
+      if ext != '*' and not ext.startswith('.') :
+        ext = '.' + ext
+      levels[ext.lower()] = level
+    return levels
+
+def new_zipinfo(arcname, level):
+    zinfo = zipfile.ZipInfo(arcname, time.localtime(time.time())[:6])
+    if level :
+      zinfo.compress_type = zipfile.ZIP_DEFLATED
+    else:
+      zinfo.compress_type = zipfile.ZIP_STORED
+    zinfo.external_attr = 0600 << 16
+    return zinfo
+
+def add_zipinfo(docxfile, zinfo):
+    '''
+       Register a member written to 'docxfile' by hand, as ZipFile.write()
+       does, so that the central directory covers it.
+    '''
+    docxfile.filelist.append(zinfo)
+    docxfile.NameToInfo[zinfo.filename] = zinfo
+    docxfile._didModify = True
+    if hasattr(docxfile, 'start_dir') :
+      docxfile.start_dir = docxfile.fp.tell()
+
+def write_part(docxfile, arcname, write, level=6, spool=True):
+    '''
+       Make the member 'arcname' of the zip file 'docxfile' with the
+       function 'write', which writes the contents to a file object.
+    '''
+    zinfo = new_zipinfo(arcname, level)
+    try:
+      zinfo._compresslevel = level
+      f = docxfile.open(zinfo, 'w', force_zip64=True)
+    except (AttributeError, RuntimeError, TypeError):
+      # zipfile can't write a member incrementally (before Python 3.6):
+      # write to a temporary file and copy it in chunks, or to memory
+      # if the part is small ('spool' is False).
+      if not spool :
+        f = StringIO()
+        write(f)
+        write_raw_part(docxfile, arcname, deflate_part(f.getvalue(), level))
+        return
+      f = tempfile.TemporaryFile(prefix='docx-', suffix='.xml')
+      try:
+        write(f)
+        write_file_part(docxfile, arcname, f, level)
+      finally:
+        f.close()
+      return
+    try:
+      write(f)
+    finally:
+      f.close()
+
+def write_file_part(docxfile, arcname, f, level=6):
+    '''
+       Copy the file object 'f' into the member 'arcname' of 'docxfile' in
+       chunks, deflated at 'level' (stored if 0).
+    '''
+    f.seek(0, 2)
+    zinfo = new_zipinfo(arcname, level)
+    zinfo.file_size = f.tell()
+    zinfo.CRC = 0
+    zinfo.compress_size = 0
+    zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+    f.seek(0)
+
+    zinfo.header_offset = docxfile.fp.tell()
+    docxfile.fp.write(zinfo.FileHeader(zip64))
+    compressor = None
+    if level :
+      compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = 0
+    while True :
+      buf = f.read(1024 * 64)
+      if not buf :
+        break
+      crc = zlib.crc32(buf, crc)
+      if compressor :
+        buf = compressor.compress(buf)
+      docxfile.fp.write(buf)
+      zinfo.compress_size += len(buf)
+    if compressor :
+      buf = compressor.flush()
+      docxfile.fp.write(buf)
+      zinfo.compress_size += len(buf)
+    zinfo.CRC = crc & 0xffffffff
+
+    # write the local header again with the CRC and the sizes
+    position = docxfile.fp.tell()
+    docxfile.fp.seek(zinfo.header_offset, 0)
+    docxfile.fp.write(zinfo.FileHeader(zip64))
+    docxfile.fp.seek(position, 0)
+    add_zipinfo(docxfile, zinfo)
+
+def deflate_part(data, level=6):
+    '''
+       Compress 'data' as a member of a zip file deflated at 'level'
+       (stored if 0), return it as write_raw_part() writes it.
+    '''
+    crc = zlib.crc32(data) & 0xffffffff
+    if not level :
+      return (zipfile.ZIP_STORED, crc, len(data), len(data), data)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    return (zipfile.ZIP_DEFLATED, crc, len(compressed), len(data), compressed)
+
+def read_raw_parts(docx, data):
+    '''
+       Return the compressed contents of the members of the zip file
+       'docx' made of 'data', as write_raw_part() copies them.
+    '''
+    result = {}
+    for zinfo in docx.infolist() :
+      if zinfo.flag_bits & 0x1 :
+        continue  # encrypted
+      offset = zinfo.header_offset
+      # the local file header: 30 bytes, the file name and the extra field
+      name_len, extra_len = struct.unpack('<2H', data[offset+26:offset+30])
+      start = offset + 30 + name_len + extra_len
+      result[zinfo.filename] = (zinfo.compress_type, zinfo.CRC,
+                                zinfo.compress_size, zinfo.file_size,
+                                data[start:start+zinfo.compress_size])
+    return result
+
+def write_raw_part(docxfile, arcname, raw):
+    '''
+       Add a member compressed beforehand (by deflate_part(), or by another
+       zip file) to 'docxfile' as it is.
+    '''
+    compress_type, crc, compress_size, file_size, data = raw
+    zinfo = new_zipinfo(arcname, 0)
+    zinfo.compress_type = compress_type
+    zinfo.CRC = crc
+    zinfo.compress_size = compress_size
+    zinfo.file_size = file_size
+
+    zinfo.header_offset = docxfile.fp.tell()
+    docxfile.fp.write(zinfo.FileHeader())
+    docxfile.fp.write(data)
+    add_zipinfo(docxfile, zinfo)
+
+def deflate_file(fname, level=6):
+    '''
+       Read the file 'fname' and compress it as deflate_part() does.
+    '''
+    f = open(fname, 'rb')
+    try:
+      return deflate_part(f.read(), level)
+    finally:
+      f.close()
+
+def deflate_xml(tree, level=6):
+    '''
+       Serialize 'tree' and compress it as deflate_part() does.
+    '''
+    return deflate_part(etree.tostring(tree, xml_declaration=True,
+                            encoding='UTF-8', standalone=True), level)
+
+def compress_parts(jobs, threads=1):
+    '''
+       Run the functions of 'jobs' in 'threads' threads (zlib and lxml
+       release the GIL while they work), yield their results in the order
+       of 'jobs', None for a job which is None.  Only a few results are
+       computed ahead of the one the caller waits for, so that the whole
+       package is never kept in memory.
+    '''
+    if threads < 2 :
+      for job in jobs :
+        yield job and job()
+      return
+
+    pool = ThreadPool(threads)
+    try:
+      pending = collections.deque()
+      for job in jobs :
+        pending.append(job and pool.apply_async(job))
+        while len(pending) > threads * 2 :
+          result = pending.popleft()
+          yield result and result.get()
+      while pending :
+        result = pending.popleft()
+        yield result and result.get()
+    finally:
+      pool.terminate()
+      pool.join()
+
+def write_xml_part(docxfile, arcname, tree, level=6, spool=True):
+    '''
+       Serialize 'tree' into the member 'arcname' of the zip file
+       'docxfile', without making the whole string in memory.
+    '''
+    def write(f):
+      etree.ElementTree(tree).write(f, xml_declaration=True, encoding='UTF-8', standalone=True)
+    write_part(docxfile, arcname, write, level, spool)
+
 #
 #  DocxDocument class
 #   This class for analizing docx-file
@@ -257,6 +662,7 @@ class DocxDocument:
     self.descriptions = ""
     self.keywords = []
     self.stylenames = {}
+    self.style_elems = None
 
     if docxfile :
       self.set_document(docxfile)
@@ -295,19 +701,86 @@ class DocxDocument:
     '''
       Extract a stylenames from the docx file
     '''
-    style_elems = get_elements(self.styles, 'w:style')
-
-    for style_elem in style_elems:
-        aliases_elems = get_elements(style_elem, 'w:aliases')
-        if aliases_elems:
-            name = aliases_elems[0].attrib[norm_name('w:val')]
-        else:
-            name_elem = get_elements(style_elem,'w:name')[0]
-            name = name_elem.attrib[norm_name('w:val')]
-        value = style_elem.attrib[norm_name('w:styleId')]
-        self.stylenames[name] = value
+    self.index_styles()
     return self.stylenames
 
+  def index_styles(self):
+    '''
+      Index the styles and the numbering in one pass: the stylenames,
+      the style elements by styleId, the list number ids of the styles
+      and the indents of the numbered styles by name.
+    '''
+    val = norm_name('w:val')
+    styleId = norm_name('w:styleId')
+    self.style_elems = {}
+    self.style_numids = {}
+    self.numbering_lefts = {}
+
+    for style_elem in get_elements(self.styles, 'w:style'):
+        name = self.index_style(style_elem)
+        if name is not None :
+            self.stylenames[name] = style_elem.attrib[styleId]
+
+    for x in get_elements(self.numbering, 'w:abstractNum') :
+      styles = get_elements(x, 'w:lvl/w:pStyle')
+      if styles and styles[0].get(val) not in self.numbering_lefts :
+        ind = get_elements(x, 'w:lvl/w:pPr/w:ind')
+        indres = [0]
+        if ind :
+          indres = [int(indx.get(norm_name('w:left'))) for indx in ind]
+        self.numbering_lefts[styles[0].get(val)] = indres
+
+  def index_style(self, style_elem):
+    '''
+      Enter a style element in the index, return the name it is known
+      by in stylenames (its alias if any).  The list number id of a name
+      is the one of the first style of the name.
+    '''
+    val = norm_name('w:val')
+    name_tag = norm_name('w:name')
+    aliases_tag = norm_name('w:aliases')
+    pPr_tag = norm_name('w:pPr')
+
+    self.style_elems[style_elem.get(norm_name('w:styleId'))] = style_elem
+    name = alias = pPr = None
+    for child in style_elem :
+      if child.tag == name_tag and name is None :
+        name = child.get(val)
+      elif child.tag == aliases_tag and alias is None :
+        alias = child.get(val)
+      elif child.tag == pPr_tag and pPr is None :
+        pPr = child
+
+    if name is not None and name not in self.style_numids :
+      self.style_numids[name] = '0'
+      if pPr is not None :
+        numId = get_elements(pPr, 'w:numPr/w:numId')
+        if numId :
+          self.style_numids[name] = numId[0].get(val)
+    if alias is not None :
+      return alias
+    return name
+
+  def get_style_index(self):
+    '''
+      The index of the styles: made on the first use by a document which
+      didn't read its styles itself (DocxTemplate.get_document()).
+    '''
+    if self.style_elems is None :
+      self.index_styles()
+    return self.style_elems
+
+  def get_style_element(self, styleId):
+    return self.get_style_index().get(styleId)
+
+  def add_style(self, style_elem):
+    '''
+      Append a style element to the styles.
+    '''
+    self.styles.append(style_elem)
+    if self.style_elems is not None :
+      self.index_style(style_elem)
+
   def get_paper_info(self):
     self.paper_info = get_elements(self.document,'/w:document/w:body/w:sectPr')[0]
     self.paper_size = get_elements(self.document,'/w:document/w:body/w:sectPr/w:pgSz')[0]
@@ -451,20 +924,10 @@ class DocxDocument:
 ##  Numbering
   def get_numbering_style_id(self, style):
     '''
-       
+       The list number id of the style named 'style', '0' if none.
     '''
-    try:
-      style_elems = get_elements(self.styles, '/w:styles/w:style')
-      for style_elem in style_elems:
-        name_elem = get_elements(style_elem,'w:name')[0]
-        name = name_elem.attrib[norm_name('w:val')]
-	if name == style :
-            numPr = get_elements(style_elem,'w:pPr/w:numPr/w:numId')[0]
-            value = numPr.attrib[norm_name('w:val')]
-            return value
-    except: 
-      pass
-    return '0'
+    self.get_style_index()
+    return self.style_numids.get(style, '0')
 
   def get_numbering_ids(self):
     '''
@@ -515,22 +978,8 @@ class DocxDocument:
     '''
        get numbering indeces
     '''
-    abstractNums=get_elements(self.numbering, 'w:abstractNum')
-
-    indres=[0]
-
-    for x in abstractNums :
-      styles=get_elements(x, 'w:lvl/w:pStyle')
-      if styles :
-        pstyle_name = styles[0].get(norm_name('w:val') )
-        if pstyle_name == style :
-          ind=get_elements(x, 'w:lvl/w:pPr/w:ind')
-	  if ind :
-            indres=[]
-	    for indx in ind :
-              indres.append(int(indx.get(norm_name('w:left'))))
-          return indres
-    return indres
+    self.get_style_index()
+    return list(self.numbering_lefts.get(style, [0]))
 
 
 ##########
@@ -564,6 +1013,412 @@ class DocxDocument:
             paratextlist.append(paratext)                    
     return paratextlist        
 
+#
+#  DocxTemplate class
+#   The contents of a style file which every new document starts from,
+#   cached by the digest of the file.  On disk, each style file has one
+#   entry, named after its path, replaced when the file changes.
+#
+TEMPLATE_CACHE_VERSION = 4
+_templates = {}
+
+# The version of the fragments of end_fragment(), for the caches of them.
+FRAGMENT_VERSION = 4
+
+def get_template(fname, cachedir=None):
+  '''
+    Return the DocxTemplate of the style file 'fname'.  Templates are kept
+    in memory, and with 'cachedir' pickled there for the next builds.
+  '''
+  f = open(fname, 'rb')
+  data = f.read()
+  f.close()
+  digest = md5(data).hexdigest()
+  if digest in _templates :
+    return _templates[digest]
+
+  template = None
+  if cachedir :
+    suffix = '-%d.pickle' % TEMPLATE_CACHE_VERSION
+    path = os.path.abspath(fname)
+    if isinstance(path, unicode) :
+      path = path.encode('utf-8')
+    cachefile = join(cachedir, md5(path).hexdigest() + suffix)
+    try:
+      f = open(cachefile, 'rb')
+      try:
+        cached, template = pickle.load(f)
+      finally:
+        f.close()
+      if cached != digest :
+        template = None
+    except Exception:
+      template = None
+  if template is None :
+    template = DocxTemplate(fname, data)
+    if cachedir :
+      try:
+        if not os.path.isdir(cachedir) :
+          os.makedirs(cachedir)
+        f = open(cachefile, 'wb')
+        try:
+          pickle.dump((digest, template), f, pickle.HIGHEST_PROTOCOL)
+        finally:
+          f.close()
+        # the entries of the other versions
+        for x in os.listdir(cachedir) :
+          if not x.endswith(suffix) :
+            os.unlink(join(cachedir, x))
+      except (IOError, OSError):
+        pass
+  template.filename = fname
+  _templates[digest] = template
+  return template
+
+class DocxTemplate:
+  def __init__(self, fname, data):
+    '''
+      Read the parts of the style file, and what DocxComposer needs of
+      its document, styles and numbering.
+    '''
+    self.filename = fname
+    docx = zipfile.ZipFile(StringIO(data))
+    self.parts = [(x, docx.read(x)) for x in docx.namelist()]
+    self.raw_parts = read_raw_parts(docx, data)
+    self.trees = None
+
+    doc = DocxDocument(fname)
+    self.stylenames = dict(doc.stylenames)
+    self.paragraph_style_id = doc.paragraph_style_id
+    self.character_style_id = doc.character_style_id
+    self.paper_info = tostring_standalone(doc.get_paper_info())
+    self.document_width = doc.document_width
+    self.document_height = doc.document_height
+    coverpage = doc.get_coverpage()
+    self.coverpage = None
+    if coverpage is not None :
+      self.coverpage = tostring_standalone(coverpage)
+    self.bullet_list_indents = doc.get_numbering_left('ListBullet')
+    self.bullet_list_numId = doc.get_numbering_style_id('ListBullet')
+    self.number_list_indent = doc.get_numbering_left('ListNumber')[0]
+    self.number_list_numId = doc.get_numbering_style_id('ListNumber')
+
+    types = etree.fromstring(self.get_part('[Content_Types].xml'))
+    # a list, in the order of the style file: a dict may come back from
+    # the pickle iterating in another order
+    self.content_types = [ (x.attrib['PartName'], x.attrib['ContentType'])
+                           for x in types.xpath('*') if 'PartName' in x.attrib ]
+    rels = etree.fromstring(self.get_part('word/_rels/document.xml.rels'))
+    self.relationships = [ [x.attrib['Type'], x.attrib['Target']]
+                           for x in rels.xpath('*') ]
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['trees'] = None
+    return state
+
+  def get_part(self, name):
+    for x, data in self.parts :
+      if x == name :
+        return data
+    raise RuntimeError('You need %r file in template' % name)
+
+  def get_document(self):
+    '''
+      Return a DocxDocument with the styles and numbering of the template,
+      which a composer can modify.
+    '''
+    if self.trees is None :
+      self.trees = (etree.fromstring(self.get_part('word/styles.xml')),
+                    etree.fromstring(self.get_part('word/numbering.xml')))
+    doc = DocxDocument()
+    doc.docxfile = self.filename
+    doc.styles = copy.deepcopy(self.trees[0])
+    doc.numbering = copy.deepcopy(self.trees[1])
+    doc.stylenames = dict(self.stylenames)
+    doc.paragraph_style_id = self.paragraph_style_id
+    doc.character_style_id = self.character_style_id
+    doc.paper_info = etree.fromstring(self.paper_info)
+    doc.document_width = self.document_width
+    doc.document_height = self.document_height
+    return doc
+
+  def get_coverpage(self):
+    if self.coverpage is None :
+      return None
+    return etree.fromstring(self.coverpage)
+
+#
+#  NumberingRegistry class
+#   The list definitions (w:abstractNum) and list instances (w:num) of a
+#   composed document, indexed by id.
+#
+class NumberingRegistry(object):
+  def __init__(self, abstractNums=(), nums=()):
+    self.abstractNums = []
+    self.abstract_keys = []
+    self.nums = []
+    self.abstract_by_id = {}
+    self.abstract_by_key = {}
+    self.num_by_id = {}
+    self.max_id = 0
+    for x in abstractNums :
+      self.add_abstract(x)
+    for x in nums :
+      self.add_num(x)
+
+  def add_abstract(self, elem, key=None):
+    '''
+       Add a w:abstractNum, which find_abstract() finds by 'key' if any.
+    '''
+    if key is not None :
+      self.abstract_by_key[key] = len(self.abstractNums)
+    self.abstractNums.append(elem)
+    self.abstract_keys.append(key)
+    self.abstract_by_id[elem.get(norm_name('w:abstractNumId'))] = elem
+
+  def add_num(self, elem):
+    nid = elem.get(norm_name('w:numId'))
+    self.nums.append(elem)
+    self.num_by_id[nid] = elem
+    if int(nid) > self.max_id :
+      self.max_id = int(nid)
+
+  def has_num(self, nId):
+    return str(nId) in self.num_by_id
+
+  def get_num(self, nId):
+    return self.num_by_id.get(str(nId))
+
+  def get_abstract(self, abstId):
+    return self.abstract_by_id.get(str(abstId))
+
+  def get_abstract_key(self, elem):
+    '''
+       The key of a w:abstractNum made by new_ListNumber_style(): its
+       level text, number format and indent.
+    '''
+    lvl = get_elements(elem, 'w:lvl')[0]
+    return (get_attribute(lvl, 'w:lvlText', 'w:val'),
+            get_attribute(lvl, 'w:numFmt', 'w:val'),
+            int(get_attribute(lvl, 'w:pPr/w:ind', 'w:left')))
+
+  def find_abstract(self, key, start=0):
+    '''
+       The last w:abstractNum added with 'key', if it is at the position
+       'start' of abstractNums or after.
+    '''
+    pos = self.abstract_by_key.get(key)
+    if pos is None or pos < start :
+      return None
+    return self.abstractNums[pos]
+
+  def share_abstracts(self, first, start=0, first_num=0):
+    '''
+       Replace the w:abstractNums from the position 'first' on by those
+       of the same key from the position 'start' on, and refer the w:nums
+       from the position 'first_num' on to them.
+    '''
+    abstractNumId = norm_name('w:abstractNumId')
+    val = norm_name('w:val')
+    added = zip(self.abstractNums[first:], self.abstract_keys[first:])
+    del self.abstractNums[first:]
+    del self.abstract_keys[first:]
+    self.abstract_by_key = {}
+    for pos, key in enumerate(self.abstract_keys) :
+      if key is not None :
+        self.abstract_by_key[key] = pos
+
+    shared = {}
+    for elem, key in added :
+      same = None
+      if key is not None :
+        same = self.find_abstract(key, start)
+      if same is None :
+        self.add_abstract(elem, key)
+      else:
+        del self.abstract_by_id[elem.get(abstractNumId)]
+        shared[elem.get(abstractNumId)] = same.get(abstractNumId)
+
+    if shared :
+      for x in self.nums[first_num:] :
+        for y in get_elements(x, 'w:abstractNumId') :
+          y.set(val, shared.get(y.get(val), y.get(val)))
+
+  def get_ids(self):
+    return [x.get(norm_name('w:numId')) for x in self.nums]
+
+#
+#  Cursor class
+#   The insertion point of a container of paragraphs (the body, the cell
+#   of an admonition): the last block appended to it, with its style.
+#
+class Cursor(object):
+  def __init__(self, container):
+    self.container = container
+    self.block = None
+    self.style = None
+
+  def advance(self, block):
+    '''
+       'block' is appended to the container.
+    '''
+    self.block = block
+    self.style = get_attribute(block, 'w:pPr/w:pStyle', 'w:val')
+
+#
+#  RunCoalescer class
+#   Merges the adjacent runs of a paragraph which have the same properties
+#   (the translator makes a run for each piece of text, the highlighter
+#   one for each token), and counts the runs and bytes it saves.
+#
+class RunCoalescer(object):
+  def __init__(self):
+    self.runs_before = 0
+    self.runs_after = 0
+    self.bytes_saved = 0
+
+  def get_key(self, run):
+    '''
+       The properties of a run which can be merged, or None: runs of text,
+       line breaks and tabs only.
+    '''
+    rPr = None
+    for x in run :
+      if x.tag == qnames['w:rPr'] :
+        rPr = etree.tostring(x, with_tail=False)
+      elif x.tag not in (qnames['w:t'], qnames['w:br'], qnames['w:tab']) :
+        return None
+    return (sorted(run.attrib.items()), rPr)
+
+  def is_joinable(self, t):
+    '''
+       The text of a w:t can be joined to another one if its spaces are
+       kept as they are.
+    '''
+    text = t.text or ''
+    return t.get(qnames['xml:space']) == 'preserve' or text == text.strip()
+
+  def merge(self, run, next_run):
+    '''
+       Move the contents of 'next_run' to the end of 'run'.
+    '''
+    last = None
+    if len(run) :
+      last = run[-1]
+    for x in list(next_run) :
+      if x.tag == qnames['w:rPr'] :
+        continue
+      if x.tag == qnames['w:t'] and last is not None and last.tag == qnames['w:t'] \
+             and self.is_joinable(last) and self.is_joinable(x) :
+        last.text = (last.text or '') + (x.text or '')
+        if x.get(qnames['xml:space']) == 'preserve' :
+          last.set(qnames['xml:space'], 'preserve')
+      else:
+        run.append(x)
+        last = x
+    next_run.getparent().remove(next_run)
+
+  def coalesce(self, elem):
+    '''
+       Merge the runs of the paragraphs and hyperlinks in 'elem'.
+    '''
+    r_tag = qnames['w:r']
+    parents = list(elem.iter(qnames['w:p'])) + list(elem.iter(qnames['w:hyperlink']))
+    for parent in parents :
+      size = None
+      run = key = None
+      for x in list(parent) :
+        if x.tag != r_tag :
+          run = key = None
+          continue
+        self.runs_before += 1
+        next_key = self.get_key(x)
+        if next_key is not None and next_key == key :
+          if size is None :
+            size = len(etree.tostring(parent, with_tail=False))
+          self.merge(run, x)
+        else:
+          self.runs_after += 1
+          run, key = x, next_key
+      if size is not None :
+        self.bytes_saved += size - len(etree.tostring(parent, with_tail=False))
+
+#
+#  Templates of the elements made for each paragraph, run, table cell and
+#  picture of the document.
+#
+paragraph_template = ElementTemplate(
+                   [['w:p'], 
+		    	[['w:pPr'], 
+	    			[['w:pStyle',{'w:val':Slot('style')}]],
+    				[['w:ind',{'w:leftChars':'0','w:left': Slot('left')} ]]
+	                ]
+		     ])
+
+paragraph_break_template = ElementTemplate(
+                   [['w:p'], 
+		    	[['w:pPr'], 
+	    			[['w:pStyle',{'w:val':Slot('style')}]],
+    				[['w:ind',{'w:leftChars':'0','w:left': Slot('left')} ]]
+	                ],
+                        [['w:r'], [['w:lastRenderedPageBreak']]]
+		     ])
+
+run_templates = {
+    # (styled, preserve spaces)
+    (False, False):ElementTemplate([['w:r'], [['w:t', Slot('text'), {}]]]),
+    (False, True):ElementTemplate([['w:r'], [['w:t', Slot('text'), {'xml:space':'preserve'}]]]),
+    (True, False):ElementTemplate([['w:r'], [['w:rPr'], [['w:rStyle',{'w:val':Slot('style')}], [['w:t', Slot('text'), {}]] ]]]),
+    (True, True):ElementTemplate([['w:r'], [['w:rPr'], [['w:rStyle',{'w:val':Slot('style')}], [['w:t', Slot('text'), {'xml:space':'preserve'}]] ]]])
+    }
+
+break_run_template = ElementTemplate([['w:r'], [['w:br']]])
+
+table_row_template = ElementTemplate([['w:tr'], [['w:trPr'], [['w:cnfStyle', {'w:val':Slot('val')}]] ] ])
+
+table_cell_template = ElementTemplate([['w:tc'], [['w:tcPr'], [['w:cnfStyle', {'w:val':Slot('val')}]] ] ])
+
+cell_width_template = ElementTemplate([['w:tcW',{'w:w':Slot('width'),'w:type':'dxa'}]])
+
+# There are 3 main elements inside a picture
+pic_tree = [['pic:pic'],
+               [['pic:nvPicPr'],  # The non visual picture properties 
+                   [['pic:cNvPr', {'id':'0','name':'Picture 1','descr':Slot('picname')}]],
+                   [['pic:cNvPicPr'], [ ['a:picLocks', {'noChangeAspect':Slot('nochangeaspect'), 'noChangeArrowheads':Slot('nochangearrowheads')} ] ] ]
+               ],
+               [['pic:blipFill'],  # The Blipfill - specifies how the image fills the picture area (stretch, tile, etc.)
+                 [['a:blip',{'r:embed':Slot('picrelid')}]],
+                 [['a:srcRect']],
+                 [['a:stretch'],[['a:fillRect']]]
+               ],
+               [['pic:spPr',{'bwMode':'auto'}],  #  The Shape properties
+                 [['a:xfrm'],[['a:off',{'x':'0','y':'0'} ]], [['a:ext',{'cx':Slot('width'),'cy':Slot('height')}]]],
+                 [['a:prstGeom',{'prst':'rect'}], ['a:avLst']],
+                 [['a:noFill']]
+               ]
+           ]
+
+graphic_tree = [['a:graphic'],
+                  [['a:graphicData', {'uri':'http://schemas.openxmlformats.org/drawingml/2006/picture'}], pic_tree ]
+               ]
+
+inline_tree = [['wp:inline',{'distT':"0",'distB':"0",'distL':"0",'distR':"0"}],
+                   [['wp:extent',{'cx':Slot('width'),'cy':Slot('height')}]],
+                   [['wp:effectExtent', {'l':'25400','t':'0','r':'0','b':'0'}]],
+                   [['wp:docPr', {'id':Slot('picid'),'name':'Picture 1','descr':Slot('picdescription')}]], 
+                   [['wp:cNvGraphicFramePr'], [['a:graphicFrameLocks',{'noChangeAspect':'1'} ]]],
+                   graphic_tree
+              ]
+
+picture_template = ElementTemplate(
+                  [['w:p'],
+                     [['w:pPr'], [['w:jc', {'w:val':Slot('align')}]]],
+                     [['w:r'], [['w:rPr'], [['w:noProof']]], [['w:drawing'], inline_tree] ]
+                  ])
+
+del pic_tree, graphic_tree, inline_tree
+
 #
 # DocxComposer Class
 #
@@ -580,6 +1435,7 @@ class DocxComposer:
     self.breakbefore = False
     self.last_paragraph = None
     self.stylenames = {}
+    self.new_styles = {}
     self.title = ""
     self.subject = ""
     self.creator = "Python:DocDocument"
@@ -590,46 +1446,54 @@ class DocxComposer:
     self.max_table_width = 8000
     self.sizeof_field_list = [2000,5500]
 
-    self.abstractNums = []
-    self.numids = []
+    self.numberings = NumberingRegistry()
 
     self.images = 0
+    self.media = []
+    self.media_rels = {}
+    self.image_infos = ImageInfoCache()
+    self.resampler = None
+    self.compression = get_compression_levels()
+    self.threads = 1
+    self.run_coalescer = None
     self.nocoverpage = False
+    self.fragment_recorders = []
 
-    if stylefile == None :
-      self.template_dir = None
-    else :
+    self.body_stream = None
+    self.held = []
+    self.flushed_numbering = {}
+    self.numbered = {}
+
+    if stylefile != None :
       self.new_document(stylefile)
 
   def set_style_file(self, stylefile):
     '''
-       Set style file 
+       Set style file (a file name, or a DocxTemplate)
     '''
-    fname = find_file(stylefile, 'sphinx-docxbuilder/docx')
-
-    if fname == None:
-      print "Error: style file( %s ) not found" % stylefile
-      return None
-      
-    self.styleDocx = DocxDocument(fname)
-
-    self.template_dir = tempfile.mkdtemp(prefix='docx-')
-    result = self.styleDocx.extract_files(self.template_dir)
-
-    if not result :
-      print "Unexpected error in copy_docx_to_tempfile"
-      shutil.rmtree(temp_dir, True)
-      self.template_dir = None
-      return 
-
-    self.stylenames = self.styleDocx.extract_stylenames()
-    self.paper_info = self.styleDocx.get_paper_info()
-    self.bullet_list_indents = self.get_numbering_left('ListBullet')
-    self.bullet_list_numId = self.styleDocx.get_numbering_style_id('ListBullet')
-    self.number_list_indent = self.get_numbering_left('ListNumber')[0]
-    self.number_list_numId = self.styleDocx.get_numbering_style_id('ListNumber')
-    self.abstractNums = get_elements(self.styleDocx.numbering, 'w:abstractNum')
-    self.numids = get_elements(self.styleDocx.numbering, 'w:num')
+    if isinstance(stylefile, DocxTemplate) :
+      self.template = stylefile
+    else:
+      fname = find_file(stylefile, 'sphinx-docxbuilder/docx')
+
+      if fname == None:
+        print "Error: style file( %s ) not found" % stylefile
+        return None
+
+      self.template = get_template(fname)
+
+    self.styleDocx = self.template.get_document()
+
+    self.stylenames = self.styleDocx.stylenames
+    self.new_styles = {}
+    self.paper_info = self.styleDocx.paper_info
+    self.bullet_list_indents = list(self.template.bullet_list_indents)
+    self.bullet_list_numId = self.template.bullet_list_numId
+    self.number_list_indent = self.template.number_list_indent
+    self.number_list_numId = self.template.number_list_numId
+    self.numberings = NumberingRegistry(
+                          get_elements(self.styleDocx.numbering, 'w:abstractNum'),
+                          get_elements(self.styleDocx.numbering, 'w:num'))
     self.numbering = make_element_tree(['w:numbering'])
 
     return
@@ -637,31 +1501,65 @@ class DocxComposer:
   def set_coverpage(self,flag=True):
     self.nocoverpage = not flag
 
+  def set_compression(self, policy):
+    '''
+       Set the compression of the members of the docx file: a preset name
+       or a dictionary of deflate levels by extension.
+    '''
+    self.compression = get_compression_levels(policy)
+
+  def get_compress_level(self, arcname):
+    ext = os.path.splitext(arcname)[1].lower()
+    return self.compression.get(ext, self.compression['*'])
+
+  def set_threads(self, threads):
+    '''
+       Compress the members of the docx file in 'threads' threads.
+    '''
+    self.threads = max(1, threads)
+
+  def set_image_infos(self, image_infos):
+    '''
+       Read the size of the pictures from 'image_infos', an ImageInfoCache
+       shared with the translator and the next builds.
+    '''
+    self.image_infos = image_infos
+
+  def set_resampler(self, resampler):
+    '''
+       Store the pictures shown smaller than they are as resampled by
+       'resampler', an ImageResampler.
+    '''
+    self.resampler = resampler
+
+  def set_coalesce_runs(self, coalesce=True):
+    '''
+       Merge the adjacent runs with the same properties when the body is
+       written.
+    '''
+    self.run_coalescer = None
+    if coalesce :
+      self.run_coalescer = RunCoalescer()
+
   def get_numbering_ids(self):
     '''
        
     '''
-    result = []
-    for num_elem in self.numids :
-        nid = num_elem.attrib[norm_name('w:numId')]
-        result.append( nid )
-    return result
+    return self.numberings.get_ids()
 
   def get_max_numbering_id(self):
     '''
        
     '''
-    max_id = 0
-    num_ids = self.get_numbering_ids()
-    for x in num_ids :
-      if int(x) > max_id :  max_id = int(x)
-    return max_id
+    return self.numberings.max_id
 
   def delete_template(self):
     '''
-       Delete the temporary directory which we use compose a new document. 
+       Release the temporary file of a document which isn't saved.
     '''
-    shutil.rmtree(self.template_dir, True)
+    if self.body_stream is not None :
+      self.body_stream.close()
+      self.body_stream = None
 
   def new_document(self, stylefile):
     '''
@@ -671,6 +1569,8 @@ class DocxComposer:
     self.document = make_element_tree([['w:document'],[['w:body']]])
     self.docbody = get_elements(self.document, '/w:document/w:body')[0]
     self.current_docbody = self.docbody
+    self.cursors = {}
+    self.cursor = self.get_cursor(self.docbody)
 
     self.relationships = self.relationshiplist()
 
@@ -692,7 +1592,8 @@ class DocxComposer:
     '''
       Save the composed document to the docx file 'docxfilename'.
     '''
-    assert os.path.isdir(self.template_dir)
+    if self.resampler is not None :
+      self.resampler.wait()
 
     self.coreproperties()
     self.appproperties()
@@ -701,61 +1602,389 @@ class DocxComposer:
 
     self.wordrelationships()
 
-    for x in self.abstractNums :
+    for x in self.numberings.abstractNums :
       self.numbering.append(x)
-    for x in self.numids :
+    for x in self.numberings.nums :
       self.numbering.append(x)
 
-    coverpage = self.styleDocx.get_coverpage()
+    if self.run_coalescer is not None :
+      self.run_coalescer.coalesce(self.docbody)
+
+    coverpage = self.template.get_coverpage()
 
     if not self.nocoverpage and coverpage is not None :
       print "output Coverpage"
-      self.docbody.insert(0,coverpage)
+      if self.body_stream is None :
+        self.docbody.insert(0,coverpage)
+      else:
+        self.coverpage = coverpage
 
     self.docbody.append(self.paper_info)
 
 
     # Serialize our trees into out zip file
-    treesandfiles = {self.document:'word/document.xml',
-                     self._coreprops:'docProps/core.xml',
-                     self._appprops:'docProps/app.xml',
-                     self._contenttypes:'[Content_Types].xml',
-                     self.numbering:'word/numbering.xml',
-                     self.styleDocx.styles:'word/styles.xml',
-                     self._websettings:'word/webSettings.xml',
-                     self._wordrelationships:'word/_rels/document.xml.rels'}
-
-    docxfile = self.styleDocx.restruct_docx(self.template_dir, docxfilename, treesandfiles.values())
-
-    for tree in treesandfiles:
-        if tree != None:
-            #print 'Saving: '+treesandfiles[tree]    
-            treestring =  etree.tostring(tree, xml_declaration=True, encoding='UTF-8', standalone='yes')
-            docxfile.writestr(treesandfiles[tree],treestring)
+    treesandfiles = [(self._contenttypes,'[Content_Types].xml'),
+                     (self._coreprops,'docProps/core.xml'),
+                     (self._appprops,'docProps/app.xml'),
+                     (self._wordrelationships,'word/_rels/document.xml.rels'),
+                     (self.styleDocx.styles,'word/styles.xml'),
+                     (self.numbering,'word/numbering.xml'),
+                     (self._websettings,'word/webSettings.xml')]
+
+    docxfile = zipfile.ZipFile(docxfilename, mode='w', compression=zipfile.ZIP_DEFLATED)
+
+    # The members in the order they are written, as (arcname, job, write):
+    # job() returns the member compressed as write_raw_part() writes it,
+    # and runs in a thread of compress_parts(); write(docxfile) writes the
+    # member here in chunks instead, when there are no threads or no job.
+    # Template parts already compressed as the policy wants are copied as
+    # they are.
+    members = []
+    media = [('word/media/'+name, filename, data) for name, filename, data in self.media]
+    skip = set([x[1] for x in treesandfiles] + [x[0] for x in media] + ['word/document.xml'])
+    for name, data in self.template.parts :
+      if name in skip :
+        continue
+      level = self.get_compress_level(name)
+      raw = self.template.raw_parts.get(name)
+      if raw is not None and (raw[0] == zipfile.ZIP_STORED) == (level == 0) :
+        members.append((name, partial(tuple, raw), None))
+      else:
+        members.append((name, partial(deflate_part, data, level), None))
+
+    # The document is the biggest member: it is written while the threads
+    # compress the following ones.
+    level = self.get_compress_level('word/document.xml')
+    if self.body_stream is not None :
+      members.append(('word/document.xml', None,
+                      partial(write_part, arcname='word/document.xml',
+                              write=self.write_document, level=level)))
+    else:
+      members.append(('word/document.xml', None,
+                      partial(write_xml_part, arcname='word/document.xml',
+                              tree=self.document, level=level)))
+
+    for arcname, filename, data in media :
+      level = self.get_compress_level(arcname)
+      if filename is not None :
+        members.append((arcname, partial(deflate_file, filename, level),
+                        partial(self.write_media_file, filename=filename,
+                                arcname=arcname, level=level)))
+      else:
+        members.append((arcname, partial(deflate_part, data, level), None))
+
+    for tree, arcname in treesandfiles :
+      if tree is not None :
+        members.append((arcname, partial(deflate_xml, tree, self.get_compress_level(arcname)), None))
+
+    if self.threads > 1 :
+      jobs = [job for arcname, job, write in members]
+    else:
+      jobs = [write is None and job or None for arcname, job, write in members]
+    for (arcname, job, write), raw in izip(members, compress_parts(jobs, self.threads)) :
+      if raw is not None :
+        write_raw_part(docxfile, arcname, raw)
+      else:
+        write(docxfile)
+
+    if self.body_stream is not None :
+      self.body_stream.close()
+      self.body_stream = None
+    if self.run_coalescer is not None :
+      rc = self.run_coalescer
+      size = docxfile.getinfo('word/document.xml').file_size
+      print 'Coalesced runs: %d -> %d, word/document.xml: %d -> %d bytes' % (
+              rc.runs_before, rc.runs_after, size + rc.bytes_saved, size)
+    docxfile.close()
     
     print 'Saved new file to: '+docxfilename
-    shutil.rmtree(self.template_dir)
     return
-    
+
+  def write_media_file(self, docxfile, filename, arcname, level):
+    f = open(filename, 'rb')
+    try:
+      write_file_part(docxfile, arcname, f, level)
+    finally:
+      f.close()
+
+##################
+####       Streaming (write finished elements of the body to a file)
+  def start_streaming(self):
+    '''
+      Write the elements appended to the body to a temporary file as soon
+      as they can't be modified any more, instead of keeping them all in
+      the document tree until save().
+    '''
+    self.body_stream = tempfile.TemporaryFile(prefix='docx-body-')
+    self.coverpage = None
+
+  def get_body_child(self, elem):
+    '''
+      The child of the body which contains 'elem', or None.
+    '''
+    while elem is not None and elem.getparent() is not self.docbody :
+      elem = elem.getparent()
+    return elem
+
+  def hold(self, elem):
+    '''
+      Keep the element (and everything after it) in the document tree,
+      it is still being filled in.
+    '''
+    self.held.append(elem)
+
+  def release(self, elem):
+    '''
+      The element held by hold(), or the one containing it, is finished.
+    '''
+    child = self.get_body_child(elem)
+    self.held = [x for x in self.held if self.get_body_child(x) is not child]
+
+  def flush_body(self):
+    '''
+      Write the leading elements of the body which are finished to the
+      body stream and drop them from the tree.  The last element, the last
+      paragraph, the current docbody and the held elements are kept.
+    '''
+    children = list(self.docbody)
+    live = [children[-1], self.get_body_child(self.last_paragraph),
+            self.get_body_child(self.current_docbody)]
+    live.extend([self.get_body_child(x) for x in self.held])
+
+    numId = norm_name('w:val')
+    numId_tag = norm_name('w:numId')
+    for elem in children :
+      if any([elem is x for x in live]) :
+        break
+      for x in get_elements(elem, 'w:pPr/w:numPr/w:numId') :
+        nid = int(x.attrib[numId])
+        self.flushed_numbering[nid] = self.flushed_numbering.get(nid, 0) + 1
+      for x in elem.iter(numId_tag) :
+        self.unindex_numbering(x)
+      out = elem
+      if self.run_coalescer is not None :
+        # the fragments being recorded keep the runs as they are
+        if self.fragment_recorders :
+          out = copy.deepcopy(elem)
+        self.run_coalescer.coalesce(out)
+      self.body_stream.write(etree.tostring(out))
+      self.docbody.remove(elem)
+
+  def write_document(self, f):
+    '''
+      Write document.xml: the body stream, and the rest of the body which
+      is still in the document tree.
+    '''
+    xmlstring = etree.tostring(self.document, xml_declaration=True, encoding='UTF-8', standalone=True)
+    head, tail = xmlstring.split('<w:body>', 1)
+    f.write(head + '<w:body>')
+    if self.coverpage is not None :
+      f.write(etree.tostring(self.coverpage))
+    self.body_stream.seek(0)
+    shutil.copyfileobj(self.body_stream, f)
+    f.write(tail)
+
  ##################
   def set_docbody(self, body=None):
     '''
       Set docx body..
     '''
     if body is None:
+      self.release(self.current_docbody)
+      if self.current_docbody is not self.docbody :
+        del self.cursors[self.current_docbody]
       self.current_docbody = self.docbody
     else:
       self.current_docbody = body
+    self.cursor = self.get_cursor(self.current_docbody)
     return self.current_docbody
 
+  def get_cursor(self, body):
+    '''
+      The cursor of a container of paragraphs.
+    '''
+    if body not in self.cursors :
+      self.cursors[body] = Cursor(body)
+    return self.cursors[body]
+
   def append(self, para):
     '''
       Append paragraph to document
     '''
     self.current_docbody.append(para)
+    self.cursor.advance(para)
     self.last_paragraph = para
+    for rec in self.fragment_recorders :
+      rec['started'] = True
+      if self.current_docbody is self.docbody :
+        rec['body'].append(para)
+    if self.body_stream is not None and self.current_docbody is self.docbody :
+      self.flush_body()
     return para
 
+##################
+####       Fragments (rendered output of a part of the document)
+  def begin_fragment(self, num_base):
+    '''
+      Start recording everything appended to the document body, and the
+      document-global state (numbering, styles, images) created for it.
+      'num_base' is the largest list number id reserved by the caller.
+    '''
+    rec = { 'body':[], 'styles':[], 'media':[],
+            'started':False, 'entry_style':None,
+            'num_base':num_base,
+            'num_start':len(self.numberings.nums),
+            'abstract_start':len(self.numberings.abstractNums),
+            'rel_base':len(self.relationships),
+            'shared_media':[] }
+    self.fragment_recorders.append(rec)
+    return rec
+
+  def get_abstract_start(self):
+    '''
+       The position of the first list definition which the lists made now
+       can share: a fragment only shares its own definitions, since it may
+       be spliced into another document.
+    '''
+    if self.fragment_recorders :
+      return self.fragment_recorders[-1]['abstract_start']
+    return 0
+
+  def end_fragment(self):
+    '''
+      Stop recording and return the fragment as a picklable dictionary.
+    '''
+    rec = self.fragment_recorders.pop()
+    base = rec['num_base']
+
+    # The dummy nums filling the gap up to 'num_base' belong to the
+    # position the fragment is spliced at, not to the fragment itself.
+    nums = [x for x in self.numberings.nums[rec['num_start']:]
+               if int(x.get(norm_name('w:numId'))) > base ]
+
+    last = None
+    if self.last_paragraph is not None :
+      for i, x in enumerate(rec['body']) :
+        if x is self.last_paragraph :
+          last = ('index', i)
+          break
+      else:
+        last = ('style', self.get_last_paragraph_style())
+
+    media = [(name, self.get_media_data(name)) for name in rec['media']]
+
+    fragment = { 'body':''.join([etree.tostring(x) for x in rec['body']]),
+             'styles':''.join([etree.tostring(x) for x in rec['styles']]),
+             'abstracts':''.join([etree.tostring(x)
+                               for x in self.numberings.abstractNums[rec['abstract_start']:]]),
+             'nums':''.join([etree.tostring(x) for x in nums]),
+             'num_base':base,
+             'rel_base':rec['rel_base'],
+             'rels':self.relationships[rec['rel_base']:],
+             'shared_media':rec['shared_media'],
+             'media':media,
+             'entry_style':rec['entry_style'],
+             'last_paragraph':last }
+
+    # Out of the fragment, its list definitions are shared with those made
+    # before it, as splice_fragment() does.
+    self.numberings.share_abstracts(rec['abstract_start'],
+                                    self.get_abstract_start(), rec['num_start'])
+    return fragment
+
+  def splice_fragment(self, fragment, num_base):
+    '''
+      Append a recorded fragment to the document body, renumbering its
+      list numbers, relationship ids and images to follow this document.
+    '''
+    shift = num_base - fragment['num_base']
+    numId = norm_name('w:numId')
+    abstractNumId = norm_name('w:abstractNumId')
+    val = norm_name('w:val')
+
+    def shift_id(elem, attr):
+      if int(elem.get(attr)) > fragment['num_base'] :
+        elem.set(attr, str(int(elem.get(attr)) + shift))
+
+    nums = parse_fragment(fragment['nums'])
+    if nums :
+      for x in range(self.get_max_numbering_id() + 1, num_base + 1) :
+        self.create_dummy_nums(x)
+    first = len(self.numberings.abstractNums)
+    first_num = len(self.numberings.nums)
+    for x in parse_fragment(fragment['abstracts']) :
+      shift_id(x, abstractNumId)
+      self.numberings.add_abstract(x, self.numberings.get_abstract_key(x))
+    for x in nums :
+      shift_id(x, numId)
+      for y in get_elements(x, 'w:abstractNumId') :
+        shift_id(y, val)
+      self.numberings.add_num(x)
+    # the list definitions which the document has already are shared, as
+    # new_ListNumber_style() shares them.
+    self.numberings.share_abstracts(first, self.get_abstract_start(), first_num)
+
+    for x in parse_fragment(fragment['styles']) :
+      styname = x.get(norm_name('w:styleId'))
+      if styname not in self.stylenames :
+        self.add_style(x, styname)
+      else:
+        self.record_style(styname)
+
+    # the images are shared with the document as picture() shares them,
+    # in the order they were used.
+    media = dict(fragment['media'])
+    shared = {}
+    for pos, relid, name in fragment['shared_media'] :
+      shared.setdefault(pos, []).append((relid, name))
+    names = {}
+    def add_image(name):
+      names[name], relid = self.add_image_relationship(md5(media[name]).hexdigest(),
+                                 os.path.splitext(name)[1], data=media[name])
+      return relid
+
+    rids = {}
+    rels = fragment['rels']
+    for i in range(len(rels) + 1) :
+      for relid, name in shared.get(i, []) :
+        rids[relid] = add_image(name)
+      if i == len(rels) :
+        break
+      rel = list(rels[i])
+      if rel[0] == image_relationship and rel[1][6:] in media :
+        rids['rId%d' % (fragment['rel_base'] + i + 1)] = add_image(rel[1][6:])
+        continue
+      self.relationships.append(rel)
+      rids['rId%d' % (fragment['rel_base'] + i + 1)] = 'rId%d' % len(self.relationships)
+
+    body = parse_fragment(fragment['body'])
+    last = fragment['last_paragraph']
+    if last is not None and last[0] == 'index' :
+      self.hold(body[last[1]])
+    rns = '{%s}' % nsprefixes['r']
+    descr = norm_name('pic:cNvPr')
+    for elem in body :
+      for x in elem.iter() :
+        if x.tag == numId :
+          shift_id(x, val)
+          self.index_numbering(x)
+        elif x.tag == descr and x.get('descr') in names :
+          x.set('descr', names[x.get('descr')])
+        for attr in x.attrib.keys() :
+          if attr.startswith(rns) and x.get(attr) in rids :
+            x.set(attr, rids[x.get(attr)])
+      self.append(elem)
+
+    if last is None :
+      self.last_paragraph = None
+    elif last[0] == 'index' :
+      self.last_paragraph = body[last[1]]
+      self.release(self.last_paragraph)
+    else :
+      self.last_paragraph = make_element_tree([['w:p'],
+                   [['w:pPr'], [['w:pStyle',{'w:val':last[1]}]] ] ])
+    return body
+
   def table_of_contents(self, toc_text='Contents:', maxlevel=3):
     '''
       Insert the Table of Content
@@ -842,26 +2071,17 @@ class DocxComposer:
     # if 'style' isn't defined, cretae new style.
     if style not in self.stylenames :
       self.new_paragraph_style(style)
+    self.record_style(style)
 
     # calcurate indent
     ind = 0
     if block_level > 0 :
         ind = self.number_list_indent * block_level
 
-    # set paragraph tree
-    paragraph_tree = [['w:p'], 
-		    	[['w:pPr'], 
-	    			[['w:pStyle',{'w:val':style}]],
-    				[['w:ind',{'w:leftChars':'0','w:left': str(ind)} ]]
-	                ]
-		     ]
-
-    if self.breakbefore :
-        paragraph_tree.append( [['w:r'], [['w:lastRenderedPageBreak']]] )
-
     # create paragraph
-    paragraph = make_element_tree(paragraph_tree)
-    return paragraph
+    if self.breakbefore :
+        return paragraph_break_template.new(style=style, left=str(ind))
+    return paragraph_template.new(style=style, left=str(ind))
 
 #################
 ####       Output Paragraph
@@ -900,9 +2120,18 @@ class DocxComposer:
     return result
 
   def get_last_paragraph_style(self):
-    result = get_attribute(self.last_paragraph,'w:pPr/w:pStyle', 'w:val')
+    if self.last_paragraph is not None and self.last_paragraph is self.cursor.block :
+      result = self.cursor.style
+    else:
+      result = get_attribute(self.last_paragraph,'w:pPr/w:pStyle', 'w:val')
     if result is None :
       result = 'BodyText'
+
+    # a fragment which reads the style before appending anything
+    # depends on what precedes it.
+    for rec in self.fragment_recorders :
+      if not rec['started'] and rec['entry_style'] is None :
+        rec['entry_style'] = result
     return result
 
   def insert_paragraph_property(self, paragraph, style='BodyText'):
@@ -911,6 +2140,7 @@ class DocxComposer:
     '''
     if style not in self.stylenames :
       self.new_paragraph_style(style)
+    self.record_style(style)
     style = self.stylenames.get(style, 'BodyText')
 
     pPr = make_element_tree( [ ['w:pPr'], [['w:pStyle',{'w:val':style}]] ] )
@@ -925,10 +2155,10 @@ class DocxComposer:
 
   def trim_paragraph(self):
     paras = get_elements(self.current_docbody, 'w:p')
-    if len(para) > 2:
+    if len(paras) > 2:
       self.last_paragraph = paras[-2]
       self.current_docbody.remove(paras[-1])
-    elif len(para) > 1:
+    elif len(paras) > 1:
       self.last_paragraph = None
       self.current_docbody.remove(paras[-1])
     return
@@ -960,7 +2190,9 @@ class DocxComposer:
     run = []
     if isinstance(targettext, (list)) :
         for i,x in enumerate(targettext) :
-            if isinstance(x, (list)) :
+            if isinstance(x, (list)) and len(x) > 2 :
+                run.append(self.make_hyperlink(x[0], x[2], style=x[1]))
+            elif isinstance(x, (list)) :
                 run.append(self.make_run(x[0], style=x[1]))
             else:
 	        if literal_block :
@@ -985,21 +2217,13 @@ class DocxComposer:
     '''
       Make a new styled run from text.
     '''
-    run_tree = [['w:r']]
-    if txt == ":br" :
-      run_tree.append([['w:br']])
-    else:
-      attr ={}
-      if txt.find(' ') != -1 :
-        attr ={'xml:space':'preserve'}
+    if txt == ":br" and not rawXml :
+      return break_run_template.new()
 
-      if style != 'Normal' :
-        if style not in self.stylenames :
-          self.new_character_style(style)
-
-	run_tree.append([['w:rPr'], [['w:rStyle',{'w:val':style}], [['w:t', txt, attr]] ]])
-      else:
-        run_tree.append([['w:t', txt, attr]])
+    if style != 'Normal' :
+      if style not in self.stylenames :
+        self.new_character_style(style)
+      self.record_style(style)
 
     # Make run element
     if rawXml:
@@ -1009,10 +2233,41 @@ class DocxComposer:
       ## remove the last run, because it could be '<w:br>'
       run.pop()
     else:
-      run = make_element_tree(run_tree)
+      template = run_templates[(style != 'Normal', txt.find(' ') != -1)]
+      run = template.new(text=txt, style=style)
                 
     return run
 
+  def make_bookmark(self, tag, anchor):
+    '''
+      Make the start or the end of the bookmark of 'anchor'.  Its id comes
+      from its name, so that it is the same wherever a fragment is spliced.
+    '''
+    name = bookmark_name(anchor)
+    attrs = {'w:id':str(zlib.crc32(name) & 0x7fffffff)}
+    if tag == 'w:bookmarkStart' :
+      attrs['w:name'] = name
+    return make_element_tree([[tag, attrs]])
+
+  def make_hyperlink(self, txt, uri, style='Hyperlink'):
+    '''
+      Make a hyperlink to an external target, or to a bookmark of the
+      document if 'uri' is '#anchor', containing a styled run.
+    '''
+    if uri.startswith('#') :
+      hyperlink = make_element_tree([['w:hyperlink', {'w:anchor':bookmark_name(uri[1:])}]])
+      hyperlink.append(self.make_run(txt, style=style))
+      return hyperlink
+
+    self.relationships.append([
+        'http://schemas.openxmlformats.org/officeDocument/2006/relationships/hyperlink',
+        uri, 'External'])
+    relid = 'rId'+str(len(self.relationships))
+
+    hyperlink = make_element_tree([['w:hyperlink', {'r:id':relid}]])
+    hyperlink.append(self.make_run(txt, style=style))
+    return hyperlink
+
   def add_br(self):
     '''
       append line break in current paragraph
@@ -1048,15 +2303,19 @@ class DocxComposer:
 
 ########
 ##     Output Headinng
-  def heading(self, headingtext, headinglevel):
+  def heading(self, headingtext, headinglevel, bookmarks=()):
     '''
-      Make a heading
+      Make a heading, the target of the bookmarks named after 'bookmarks'
     '''
     # Make paragraph element
     paragraph = make_element_tree(['w:p'])
     self.insert_paragraph_property(paragraph, 'Heading'+str(headinglevel))
 
+    for anchor in bookmarks :
+      paragraph.append(self.make_bookmark('w:bookmarkStart', anchor))
     self.make_runs(paragraph, headingtext)
+    for anchor in bookmarks :
+      paragraph.append(self.make_bookmark('w:bookmarkEnd', anchor))
 
     self.last_paragraph = paragraph
     self.append(paragraph)
@@ -1106,25 +2365,57 @@ class DocxComposer:
 
     return result
      
+  def index_numbering(self, numId):
+    '''
+       Enter a w:numId element in the index of the numbered paragraphs.
+    '''
+    nid = int(numId.get(norm_name('w:val')))
+    self.numbered.setdefault(nid, []).append(numId)
+
+  def unindex_numbering(self, numId):
+    nid = int(numId.get(norm_name('w:val')))
+    elems = self.numbered.get(nid, [])
+    for i, x in enumerate(elems) :
+      if x is numId :
+        del elems[i]
+        break
+
   def find_numbering_paragraph(self, nId):
     '''
-       
+       The paragraphs of the body numbered with 'nId', in the order they
+       were numbered, found by the index of their w:numId elements.
     '''
     result =[]
-    for p in self.docbody :
-      elem = get_elements(p, 'w:pPr/w:numPr/w:numId')
-      for x in elem:
-        if int(x.attrib[norm_name('w:val')]) == int(nId) :
-          result.append(p)
+    numPr = norm_name('w:numPr')
+    pPr = norm_name('w:pPr')
+    for x in self.numbered.get(int(nId), []) :
+      parent = x.getparent()
+      if parent is None or parent.tag != numPr :
+        continue
+      parent = parent.getparent()
+      if parent is None or parent.tag != pPr :
+        continue
+      p = parent.getparent()
+      if p is not None and p.getparent() is self.docbody :
+        result.append(p)
     return result
 
+  def count_numbering_paragraph(self, nId):
+    '''
+       Number of the paragraphs of the body numbered with 'nId', with
+       those already written to the body stream.
+    '''
+    return self.flushed_numbering.get(int(nId), 0) + len(self.find_numbering_paragraph(nId))
+
   def set_numbering_id(self, paragraph, nId):
     '''
        
     '''
     elem = get_elements(paragraph, 'w:pPr/w:numPr/w:numId')
     if elem :
+        self.unindex_numbering(elem[0])
         elem[0].set(norm_name('w:val'), str(nId))
+        self.index_numbering(elem[0])
 
   def replace_numbering_id(self, oldId, newId):
     '''
@@ -1153,7 +2444,7 @@ class DocxComposer:
         num_id = self.styleDocx.get_numbering_style_id(style)
     else :
       num_id = str(nId)
-      if num_id not in self.get_numbering_ids() :
+      if not self.numberings.has_num(num_id) :
 
 	if enum_prefix : lvl_text=enum_prefix
         newid = self.get_max_numbering_id()+1
@@ -1162,6 +2453,7 @@ class DocxComposer:
 
     numPr_tree =[['w:numPr'], [['w:ilvl',{'w:val': str(ilvl)}]], [['w:numId',{'w:val': num_id}]] ]
     numPr = make_element_tree(numPr_tree)
+    self.index_numbering(numPr[1])
 
     pPr.append(numPr)
 
@@ -1208,7 +2500,7 @@ class DocxComposer:
                    [['w:abstractNumId', {'w:val': orig_numid}] ],
 	  ]
     num = make_element_tree(num_tree)
-    self.numids.append(num)
+    self.numberings.add_num(num)
     return
 
   def new_ListNumber_style(self, nId, start_val=1, lvl_txt='%1.', typ=None):
@@ -1226,8 +2518,14 @@ class DocxComposer:
 
     typ =  get_enumerate_type(typ)
 
+    # The lists of the same format share one definition, and each of them
+    # restarts its numbering with a startOverride.
     ind = self.number_list_indent
-    abstnum_tree = [['w:abstractNum', {'w:abstractNumId':str(abstnewid)}],
+    key = (lvl_txt, typ, ind)
+    abstnum = self.numberings.find_abstract(key, self.get_abstract_start())
+
+    if abstnum is None :
+      abstnum_tree = [['w:abstractNum', {'w:abstractNumId':str(abstnewid)}],
                        [['w:multiLevelType', {'w:val':'singleLevel'}] ],
                        [['w:lvl', {'w:ilvl':'0'}],
                               [['w:start', {'w:val':str(start_val)}]] ,
@@ -1237,15 +2535,17 @@ class DocxComposer:
 			      [['w:pPr'], [['w:ind',{'w:left':str(ind), 'w:hanging':str(ind)} ]]]
 		       ]
                     ]
+      abstnum = make_element_tree(abstnum_tree)
+      self.numberings.add_abstract(abstnum, key)
 
     num_tree = [['w:num', {'w:numId':str(newid)}],
-                   [['w:abstractNumId', {'w:val':str(abstnewid)}] ],
+                   [['w:abstractNumId', {'w:val':abstnum.get(norm_name('w:abstractNumId'))}] ],
+                   [['w:lvlOverride', {'w:ilvl':'0'}],
+                       [['w:startOverride', {'w:val':str(start_val)}]] ]
                ]
 
-    abstnum = make_element_tree(abstnum_tree)
     num = make_element_tree(num_tree)
-    self.abstractNums.append(abstnum)
-    self.numids.append(num)
+    self.numberings.add_num(num)
     return  newid
 
 ########## 
@@ -1261,9 +2561,7 @@ class DocxComposer:
                     ]
 
     newstyle = make_element_tree(newstyle_tree)
-    self.styleDocx.styles.append(newstyle)
-    self.stylenames[styname] = styname
-    return styname
+    return self.add_style(newstyle, styname)
 
   def new_paragraph_style(self, styname):
     '''
@@ -1276,11 +2574,31 @@ class DocxComposer:
                     ]
 
     newstyle = make_element_tree(newstyle_tree)
+    return self.add_style(newstyle, styname)
 
-    self.styleDocx.styles.append(newstyle)
+  def add_style(self, newstyle, styname):
+    '''
+       Append a style element to the styles of the document
+    '''
+    self.styleDocx.add_style(newstyle)
     self.stylenames[styname] = styname
+    self.new_styles[styname] = newstyle
+    self.record_style(styname)
     return styname
 
+  def record_style(self, styname):
+    '''
+       Record a style made by the composer in the fragments being recorded
+       which use it, whichever made it: a fragment may be spliced where it
+       wasn't made.
+    '''
+    if not self.fragment_recorders or styname not in self.new_styles :
+      return
+    newstyle = self.new_styles[styname]
+    for rec in self.fragment_recorders :
+      if not any([x is newstyle for x in rec['styles']]) :
+        rec['styles'].append(newstyle)
+
 ############
 ## Table
   
@@ -1318,9 +2636,7 @@ class DocxComposer:
     else :
       trPr_val = '000000010000'
 
-    tr_tree = [['w:tr'], [['w:trPr'], [['w:cnfStyle', {'w:val':trPr_val}]] ] ]
-
-    row = make_element_tree(tr_tree)
+    row = table_row_template.new(val=trPr_val)
 
     for i in range(n_cells):   
       i - firstCol
@@ -1331,15 +2647,13 @@ class DocxComposer:
       else :
         tcPr_val = '000001000000'
 
-      tc_tree = [['w:tc'], [['w:tcPr'], [['w:cnfStyle', {'w:val':tcPr_val}]] ] ]
-      cell = make_element_tree(tc_tree)
+      cell = table_cell_template.new(val=tcPr_val)
       row.append(cell)
 
       # Properties
-      cellprops = get_elements(cell,'w:tcPr')[0]
+      cellprops = cell[0]
       if cellsize > 0:
-        cellwidth = make_element_tree([['w:tcW',{'w:w':str(cellsize[i]),'w:type':'dxa'}]])
-        cellprops.append(cellwidth)
+        cellprops.append(cell_width_template.new(width=str(cellsize[i])))
 
       if contents :
         cell.append(self.paragraph(contents[i], create_only=True))
@@ -1401,6 +2715,7 @@ class DocxComposer:
        
     '''
     table = self.create_table(self.sizeof_field_list,tstyle='FieldList')
+    self.hold(table)
     self.append(table)
     return table
 
@@ -1430,6 +2745,7 @@ class DocxComposer:
        
     '''
     table = self.create_table([self.max_table_width -500],tstyle='OptionList')
+    self.hold(table)
     self.append(table)
     return table
 
@@ -1444,6 +2760,8 @@ class DocxComposer:
     
     self.append_paragrap_to_table_cell(table, self.paragraph(title, create_only=True) , [0,0])
 
+    # released by set_docbody() when the admonition is finished
+    self.hold(table)
     self.append(table)
     self.insert_linespace()
 
@@ -1487,27 +2805,21 @@ class DocxComposer:
     # http://openxmldeveloper.org/articles/462.aspx
     # Create an image. Size may be specified, otherwise it will based on the
     # pixel size of image. Return a paragraph containing the picture'''  
-    # Copy the file into the media dir
-    media_dir = join(self.template_dir,'word','media')
-    if not os.path.isdir(media_dir):
-        os.mkdir(media_dir)
-#    picpath, picname = os.path.abspath(picname), os.path.basename(picname)
-
-    picpath, picname = os.path.abspath(picname), os.path.basename(picname)
-    picext = os.path.splitext(picname)
-    self.images += 1
-    if (picext[1] == '.jpg') :
-      picname = 'image'+str(self.images)+'.jpeg'
-    else:
-      picname = 'image'+str(self.images)+picext[1]
-
-    shutil.copyfile(picpath, join(media_dir,picname))
-    relationshiplist = self.relationships
+    # Store the image in the media of the document, once for all its uses
+    picpath = os.path.abspath(picname)
+    digest = self.image_infos.get_digest(picpath)
+    if self.resampler is not None and pixelwidth and pixelheight :
+      size = self.resampler.get_size(picpath, self.image_infos.get_size(picpath),
+                                     (pixelwidth, pixelheight))
+      if size is not None :
+        digest, picpath = self.resampler.resample(picpath, digest, size)
+    picname, picrelid = self.add_image_relationship(digest,
+                                 os.path.splitext(picpath)[1], filename=picpath)
 
     # Check if the user has specified a size
     if not pixelwidth or not pixelheight:
         # If not, get info from the picture itself
-        pixelwidth,pixelheight = Image.open(picpath).size[0:2]
+        pixelwidth,pixelheight = self.image_infos.get_size(picpath)
 
     # OpenXML measures on-screen objects in English Metric Units
     # 1cm = 36000 EMUs            
@@ -1515,75 +2827,81 @@ class DocxComposer:
     width = str(pixelwidth * emuperpixel)
     height = str(pixelheight * emuperpixel)   
     
-    # Set relationship ID to the first available  
     picid = '2'    
-    picrelid = 'rId'+str(len(relationshiplist)+1)
-    relationshiplist.append([
-        'http://schemas.openxmlformats.org/officeDocument/2006/relationships/image',
-        'media/'+picname])
-    
-    # There are 3 main elements inside a picture
-    pic_tree = [['pic:pic'],
-                   [['pic:nvPicPr'],  # The non visual picture properties 
-                       [['pic:cNvPr', {'id':'0','name':'Picture 1','descr':picname}]],
-                       [['pic:cNvPicPr'], [ ['a:picLocks', {'noChangeAspect':str(int(nochangeaspect)), 'noChangeArrowheads':str(int(nochangearrowheads))} ] ] ]
-                   ],
-                   [['pic:blipFill'],  # The Blipfill - specifies how the image fills the picture area (stretch, tile, etc.)
-                     [['a:blip',{'r:embed':picrelid}]],
-                     [['a:srcRect']],
-		     [['a:stretch'],[['a:fillRect']]]
-		   ],
-                   [['pic:spPr',{'bwMode':'auto'}],  #  The Shape properties
-		     [['a:xfrm'],[['a:off',{'x':'0','y':'0'} ]], [['a:ext',{'cx':width,'cy':height}]]],
-		     [['a:prstGeom',{'prst':'rect'}], ['a:avLst']],
-		     [['a:noFill']]
-		   ]
-	       ]
-
-    graphic_tree = [['a:graphic'],
-                      [['a:graphicData', {'uri':'http://schemas.openxmlformats.org/drawingml/2006/picture'}], pic_tree ]
-
-		      ]
-
-    inline_tree = [['wp:inline',{'distT':"0",'distB':"0",'distL':"0",'distR':"0"}],
-                       [['wp:extent',{'cx':width,'cy':height}]],
-                       [['wp:effectExtent', {'l':'25400','t':'0','r':'0','b':'0'}]],
-                       [['wp:docPr', {'id':picid,'name':'Picture 1','descr':picdescription}]], 
-                       [['wp:cNvGraphicFramePr'], [['a:graphicFrameLocks',{'noChangeAspect':'1'} ]]],
-		       graphic_tree
-		       ]
-
-    paragraph_tree = [['w:p'],
-                         [['w:pPr'], [['w:jc', {'w:val':align}]]],
-			 [['w:r'], [['w:rPr'], [['w:noProof']]], [['w:drawing'], inline_tree] ]
-			 ]
-
-
-    paragraph = make_element_tree(paragraph_tree)
-    self.relationships = relationshiplist
+    paragraph = picture_template.new(picname=picname,
+                    nochangeaspect=str(int(nochangeaspect)),
+                    nochangearrowheads=str(int(nochangearrowheads)),
+                    picrelid=picrelid, width=width, height=height,
+                    picid=picid, picdescription=picdescription, align=align)
     self.append(paragraph)
 
     self.last_paragraph = None
     return paragraph
 
 
+  def add_image_relationship(self, digest, ext, filename=None, data=None):
+    '''
+      Return the media file name and the relationship id of an image whose
+      contents have the md5 'digest'.  An image already in the document is
+      stored once, and all its uses share one relationship.
+    '''
+    if digest in self.media_rels :
+      picname, relid = self.media_rels[digest]
+      # a fragment refers to the images of the document before it by
+      # their position in its relationships, to add them when spliced.
+      for rec in self.fragment_recorders :
+        if int(relid[3:]) <= rec['rel_base'] :
+          rec['shared_media'].append((len(self.relationships) - rec['rel_base'],
+                                      relid, picname))
+          if picname not in rec['media'] :
+            rec['media'].append(picname)
+      return picname, relid
+
+    picname = self.add_media(ext, filename=filename, data=data)
+    self.relationships.append([image_relationship, 'media/'+picname])
+    relid = 'rId%d' % len(self.relationships)
+    self.media_rels[digest] = (picname, relid)
+    return picname, relid
+
+  def add_media(self, ext, filename=None, data=None):
+    '''
+      Add an image file (or its contents) to the media of the document,
+      return the name of the new media file.  Files are read on save().
+    '''
+    self.images += 1
+    if ext == '.jpg' :
+      ext = '.jpeg'
+    picname = 'image'+str(self.images)+ext
+
+    self.media.append((picname, filename, data))
+
+    for rec in self.fragment_recorders :
+      rec['media'].append(picname)
+    return picname
+
+  def get_media_data(self, picname):
+    '''
+      Return the contents of the media file 'picname'.
+    '''
+    for name, filename, data in self.media :
+      if name == picname :
+        if filename is None :
+          return data
+        if self.resampler is not None :
+          self.resampler.wait(filename)
+        f = open(filename, 'rb')
+        try:
+          return f.read()
+        finally:
+          f.close()
+    return None
+
   def contenttypes(self):
     '''
        create [Content_Types].xml 
        This function copied from 'python-docx' library
     '''
-    prev_dir = os.getcwd() # save previous working dir
-    os.chdir(self.template_dir)
-
-    filename = '[Content_Types].xml'
-    if not os.path.exists(filename):
-        raise RuntimeError('You need %r file in template' % filename)
-
-    parts = dict([
-        (x.attrib['PartName'], x.attrib['ContentType'])
-        for x in etree.fromstring(open(filename).read()).xpath('*')
-        if 'PartName' in x.attrib
-    ])
+    parts = self.template.content_types
 
     # Add support for filetypes
     filetypes = {'rels':'application/vnd.openxmlformats-package.relationships+xml',
@@ -1595,14 +2913,13 @@ class DocxComposer:
 
     types_tree = [['Types']]
 
-    for part in parts:
-      types_tree.append([['Override',{'PartName':part,'ContentType':parts[part]}]])
+    for part, content_type in parts:
+      types_tree.append([['Override',{'PartName':part,'ContentType':content_type}]])
 
     for extension in filetypes:
       types_tree.append([['Default',{'Extension':extension,'ContentType':filetypes[extension]}]])
 
     types = make_element_tree(types_tree, nsprefixes['ct'])
-    os.chdir(prev_dir)
     self._contenttypes = types
     return types
 
@@ -1677,22 +2994,7 @@ class DocxComposer:
     return web
 
   def relationshiplist(self):
-    prev_dir = os.getcwd() # save previous working dir
-    os.chdir(self.template_dir)
-
-    filename = 'word/_rels/document.xml.rels'
-    if not os.path.exists(filename):
-        raise RuntimeError('You need %r file in template' % filename)
-
-    relationships = etree.fromstring(open(filename).read())
-    relationshiplist = [
-            [x.attrib['Type'], x.attrib['Target']]
-            for x in relationships.xpath('*')
-    ]
-
-    os.chdir(prev_dir)
-
-    return relationshiplist
+    return [list(x) for x in self.template.relationships]
 
   def wordrelationships(self):
     '''
@@ -1704,7 +3006,10 @@ class DocxComposer:
     count = 0
     for relationship in self.relationships:
         # Relationship IDs (rId) start at 1.
-	rel_tree.append([['Relationship',{'Id':'rId'+str(count+1), 'Type':relationship[0],'Target':relationship[1]}]])
+        attrs = {'Id':'rId'+str(count+1), 'Type':relationship[0],'Target':relationship[1]}
+        if len(relationship) > 2 :
+          attrs['TargetMode'] = relationship[2]
+	rel_tree.append([['Relationship', attrs]])
         count += 1
 
     relationships = make_element_tree(rel_tree, nsprefixes['pr'])
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+'''
+  Size, resolution and digest of the images of a document
+
+  The size and dpi of PNG, JPEG and GIF files are read from their headers
+  without decoding them, the other images are opened with PIL.  The
+  results are kept by file name, and on disk for the next builds.
+'''
+
+import os
+import struct
+import cPickle as pickle
+from hashlib import md5
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+try:
+  import Image
+except ImportError:
+  Image = None
+
+# The version of the pickled results, to ignore those of other versions.
+IMAGE_INFO_VERSION = 2
+
+# The threads reading the images ahead, mostly waiting for the files.
+PREFETCH_THREADS = 8
+
+def digest_file(fname):
+  '''
+     The md5 digest of the contents of the file 'fname'.
+  '''
+  digest = md5()
+  f = open(fname, 'rb')
+  try:
+    for chunk in iter(partial(f.read, 1 << 16), '') :
+      digest.update(chunk)
+  finally:
+    f.close()
+  return digest.hexdigest()
+
+def probe_png(f):
+  '''
+     The size of a PNG file from its IHDR chunk, the dpi from its pHYs
+     chunk (in pixels per meter only).
+  '''
+  head = f.read(24)
+  if len(head) < 24 or head[:8] != '\x89PNG\r\n\x1a\n' or head[12:16] != 'IHDR' :
+    return None
+  width, height = struct.unpack('>II', head[16:24])
+  dpi = None
+  f.seek(8)
+  while True :
+    chunk = f.read(8)
+    if len(chunk) < 8 :
+      break
+    length, tag = struct.unpack('>I4s', chunk)
+    if tag == 'IDAT' or tag == 'IEND' :
+      break
+    if tag == 'pHYs' and length >= 9 :
+      px, py, unit = struct.unpack('>IIB', f.read(9))
+      if unit == 1 :
+        dpi = (int(px * 0.0254 + 0.5), int(py * 0.0254 + 0.5))
+      break
+    f.seek(length + 4, 1)
+  return width, height, dpi
+
+def probe_jpeg(f):
+  '''
+     The size of a JPEG file from its SOF segment, the dpi from its JFIF
+     segment (in dots per inch only).  None for the files whose dpi PIL
+     reads from the Exif data.
+  '''
+  if f.read(2) != '\xff\xd8' :
+    return None
+  dpi = None
+  exif = False
+  while True :
+    byte = f.read(1)
+    while byte and byte != '\xff' :
+      byte = f.read(1)
+    while byte == '\xff' :
+      byte = f.read(1)
+    if not byte :
+      return None
+    marker = ord(byte)
+    if marker == 0xd8 or marker == 0x01 or 0xd0 <= marker <= 0xd7 :
+      continue
+    if marker == 0xd9 or marker == 0xda :
+      return None
+    length = f.read(2)
+    if len(length) < 2 :
+      return None
+    length = struct.unpack('>H', length)[0] - 2
+    if marker in (0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7,
+                  0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf) :
+      sof = f.read(5)
+      if len(sof) < 5 :
+        return None
+      height, width = struct.unpack('>HH', sof[1:5])
+      if dpi is None and exif :
+        return None
+      return width, height, dpi
+    data = f.read(length)
+    if marker == 0xe0 and data[:5] == 'JFIF\0' and len(data) >= 12 :
+      if ord(data[7]) == 1 :
+        dpi = struct.unpack('>HH', data[8:12])
+    elif marker == 0xe1 and data[:5] == 'Exif\0' :
+      exif = True
+
+def probe_gif(f):
+  '''
+     The size of a GIF file from its logical screen descriptor.
+  '''
+  head = f.read(10)
+  if len(head) < 10 or head[:6] not in ('GIF87a', 'GIF89a') :
+    return None
+  width, height = struct.unpack('<HH', head[6:10])
+  return width, height, None
+
+probes = [probe_png, probe_jpeg, probe_gif]
+
+def probe(fname):
+  '''
+     Return (width, height, dpi) of the image file 'fname' read from its
+     header, dpi being None if the file doesn't tell it.  None if the
+     format isn't known.
+  '''
+  f = open(fname, 'rb')
+  try:
+    for func in probes :
+      f.seek(0)
+      try:
+        result = func(f)
+      except struct.error :
+        result = None
+      if result is not None :
+        return result
+  finally:
+    f.close()
+  return None
+
+def open_image(fname):
+  '''
+     Return (width, height, dpi) of the image file 'fname' opened with PIL.
+  '''
+  if Image is None :
+    raise RuntimeError('image size not fully specified and PIL not installed')
+  try:
+    imageobj = Image.open(fname, 'r')
+  except:
+    raise RuntimeError('Fail to open image file: %s' % fname)
+  dpi = imageobj.info.get('dpi')
+  # dpi information can be (xdpi, ydpi) or xydpi
+  if dpi is not None :
+    try: iter(dpi)
+    except: dpi = (dpi, dpi)
+    dpi = tuple(dpi)
+  return imageobj.size[0], imageobj.size[1], dpi
+
+#
+#  ImageInfoCache class
+#   The results of probe() and digest_file() by file name, valid as long
+#   as the size and the modification time of the file are the same.  A
+#   file is checked once per build.  The entries a worker process made
+#   are passed back to the builder with get_changes() and update().
+#
+class ImageInfoCache(object):
+  def __init__(self, cachefile=None):
+    self.cachefile = cachefile
+    self.infos = {}
+    self.checked = set()
+    self.changed = set()
+    self.modified = False
+    if cachefile and os.path.isfile(cachefile) :
+      try:
+        f = open(cachefile, 'rb')
+        try:
+          version, infos = pickle.load(f)
+        finally:
+          f.close()
+        if version == IMAGE_INFO_VERSION :
+          self.infos = infos
+      except Exception:
+        pass
+
+  def get_entry(self, fname):
+    '''
+       The entry of the image file 'fname': [stamp, info, digest], where
+       info and digest are None until they are known.
+    '''
+    entry = self.infos.get(fname)
+    if fname in self.checked :
+      return entry
+    try:
+      st = os.stat(fname)
+    except OSError:
+      raise RuntimeError('Fail to open image file: %s' % fname)
+    stamp = (st.st_mtime, st.st_size)
+    if entry is None or entry[0] != stamp :
+      entry = self.infos[fname] = [stamp, None, None]
+      self.changed.add(fname)
+      self.modified = True
+    self.checked.add(fname)
+    return entry
+
+  def get(self, fname):
+    '''
+       Return (width, height, dpi) of the image file 'fname'.
+    '''
+    fname = os.path.abspath(fname)
+    entry = self.get_entry(fname)
+    if entry[1] is None :
+      info = probe(fname)
+      if info is None :
+        info = open_image(fname)
+      entry[1] = info
+      self.changed.add(fname)
+      self.modified = True
+    return entry[1]
+
+  def get_size(self, fname):
+    return self.get(fname)[0:2]
+
+  def get_digest(self, fname):
+    '''
+       Return the md5 digest of the contents of the image file 'fname'.
+    '''
+    fname = os.path.abspath(fname)
+    entry = self.get_entry(fname)
+    if entry[2] is None :
+      entry[2] = digest_file(fname)
+      self.changed.add(fname)
+      self.modified = True
+    return entry[2]
+
+  def prefetch(self, fnames, threads=PREFETCH_THREADS):
+    '''
+       Read the size and the digest of the image files 'fnames' in
+       'threads' threads, so that get() and get_digest() find them ready.
+    '''
+    def read(fname):
+      try:
+        self.get(fname)
+        self.get_digest(fname)
+      except Exception:
+        # reported when the image is used
+        pass
+
+    fnames = list(set([os.path.abspath(x) for x in fnames]))
+    if not fnames :
+      return
+    pool = ThreadPool(min(threads, len(fnames)))
+    try:
+      pool.map(read, fnames, 1)
+    finally:
+      pool.close()
+      pool.join()
+
+  def get_changes(self):
+    '''
+       The entries made or completed since the cache was loaded.
+    '''
+    return dict([(x, self.infos[x]) for x in self.changed])
+
+  def update(self, entries):
+    '''
+       Take the entries of get_changes() of another process.
+    '''
+    for fname, entry in entries.items() :
+      self.infos[fname] = entry
+      self.checked.add(fname)
+      self.changed.add(fname)
+      self.modified = True
+
+  def save(self):
+    '''
+       Write the results to the cache file, if any changed.
+    '''
+    if not self.cachefile or not self.modified :
+      return
+    try:
+      f = open(self.cachefile, 'wb')
+      try:
+        pickle.dump((IMAGE_INFO_VERSION, self.infos), f, pickle.HIGHEST_PROTOCOL)
+      finally:
+        f.close()
+      self.modified = False
+    except (IOError, OSError):
+      pass
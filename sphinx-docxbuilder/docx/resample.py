@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+'''
+  Resampling of the images shown smaller than they are
+
+  An image which has many more pixels than needed at the size it is shown
+  and the resolution asked for is scaled down and saved again (PNG files
+  optimized, JPEG files with the quality asked for) in a pool of worker
+  processes.  The results are kept in a directory, named after the digest
+  of the image and the target size, for the next builds.
+'''
+
+import os
+import shutil
+import multiprocessing
+from hashlib import md5
+
+try:
+  import Image
+except ImportError:
+  Image = None
+
+# An image is resampled only when it is this much bigger than needed.
+MIN_RATIO = 1.2
+
+# The formats resampled, by extension
+RESAMPLE_FORMATS = {'.png':'PNG', '.jpg':'JPEG', '.jpeg':'JPEG'}
+
+def resample_image(src, dst, size, quality=85):
+  '''
+     Scale the image file 'src' to 'size' and save it to 'dst', or copy
+     'src' there if the result isn't smaller.
+  '''
+  fmt = RESAMPLE_FORMATS[os.path.splitext(src)[1].lower()]
+  im = Image.open(src)
+  # an image with a palette is scaled in RGB, then gets a palette again
+  colors = None
+  if im.mode == 'P' and 'transparency' not in im.info :
+    colors = len(im.getcolors(256) or ()) or 256
+  if im.mode not in ('RGB', 'RGBA', 'L', 'LA', 'CMYK') :
+    if 'transparency' in im.info :
+      im = im.convert('RGBA')
+    else:
+      im = im.convert('RGB')
+  im = im.resize(size, Image.ANTIALIAS)
+
+  tmpname = '%s.%d.tmp' % (dst, os.getpid())
+  if fmt == 'JPEG' :
+    if im.mode in ('RGBA', 'LA') :
+      im = im.convert('RGB')
+    im.save(tmpname, 'JPEG', quality=quality, optimize=True)
+  else:
+    if colors is not None :
+      im = im.quantize(colors)
+    im.save(tmpname, 'PNG', optimize=True)
+  # the original is kept if it is the smaller one
+  if os.path.getsize(tmpname) >= os.path.getsize(src) :
+    shutil.copyfile(src, tmpname)
+  os.rename(tmpname, dst)
+
+#
+#  ImageResampler class
+#   The resampled images of a build.  With more than one process, the
+#   images are resampled while the document is composed, wait() returns
+#   once they are written.
+#
+class ImageResampler(object):
+  def __init__(self, cachedir, dpi=150, quality=85, processes=1):
+    self.cachedir = cachedir
+    self.dpi = dpi
+    self.quality = quality
+    self.processes = processes
+    self.pool = None
+    self.pending = {}
+    self.used = set()
+    if not os.path.isdir(cachedir) :
+      os.makedirs(cachedir)
+
+  def get_size(self, fname, size, shown):
+    '''
+       The size in pixels to resample the image file 'fname' of 'size' to,
+       shown at 'shown' (in pixels at 72 dpi).  None if it isn't worth it.
+    '''
+    if Image is None or os.path.splitext(fname)[1].lower() not in RESAMPLE_FORMATS :
+      return None
+    target = (max(1, int(shown[0] * self.dpi / 72.0 + 0.5)),
+              max(1, int(shown[1] * self.dpi / 72.0 + 0.5)))
+    if size[0] < target[0] * MIN_RATIO or size[1] < target[1] * MIN_RATIO :
+      return None
+    return target
+
+  def resample(self, fname, digest, size):
+    '''
+       Resample the image file 'fname' whose contents have the md5 'digest'
+       to 'size'.  Return the digest of the result and its file name.
+    '''
+    ext = os.path.splitext(fname)[1].lower()
+    key = md5('%s %dx%d %d' % (digest, size[0], size[1], self.quality)).hexdigest()
+    dst = os.path.join(self.cachedir, key + ext)
+    self.used.add(key + ext)
+    if dst in self.pending or os.path.isfile(dst) :
+      return key, dst
+
+    # the workers of a parallel build are daemons, they can't start a pool
+    if self.processes > 1 and not multiprocessing.current_process().daemon :
+      if self.pool is None :
+        self.pool = multiprocessing.Pool(self.processes)
+      self.pending[dst] = (self.pool.apply_async(resample_image,
+                               (fname, dst, size, self.quality)), fname)
+    else:
+      try:
+        resample_image(fname, dst, size, self.quality)
+      except Exception:
+        shutil.copyfile(fname, dst)
+    return key, dst
+
+  def wait(self, dst=None):
+    '''
+       Wait for the resampled file 'dst', or for all of them.  An image
+       which can't be resampled is used as it is.
+    '''
+    if dst is None :
+      names = self.pending.keys()
+    elif dst in self.pending :
+      names = [dst]
+    else:
+      return
+    for name in names :
+      result, src = self.pending.pop(name)
+      try:
+        result.get()
+      except Exception:
+        shutil.copyfile(src, name)
+
+  def close(self):
+    self.wait()
+    if self.pool is not None :
+      self.pool.close()
+      self.pool.join()
+      self.pool = None
+
+  def prune(self):
+    '''
+       Remove the resampled images which were not used by this build.
+    '''
+    for fname in os.listdir(self.cachedir) :
+      if fname not in self.used :
+        try:
+          os.unlink(os.path.join(self.cachedir, fname))
+        except OSError:
+          pass
@@ -36,17 +36,11 @@ import sys
 import os
 import zipfile
 import tempfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from lxml import etree
 from highlight import *
 
-
-#
-# Is the PIL imaging library installed?
-try:
-    import Image
-except ImportError, exp:
-    Image = None
-
 #
 #  Logging for debugging
 #
@@ -100,6 +94,14 @@ def findElement(elem, tag):
       res = None
   return res
 
+def has_ancestor(node, cls):
+  parent = node.parent
+  while parent is not None :
+    if isinstance(parent, cls):
+      return True
+    parent = parent.parent
+  return False
+
 def get_toc_maxdepth(builder, docname):
   toc_maxdepth = 0
   try:
@@ -139,10 +141,23 @@ class DocxWriter(writers.Writer):
           self.coverpage = True
 
         stylefile = self.builder.config['docx_style']
-        if stylefile :
+        if self.builder.template is not None :
+            self.docx.new_document(self.builder.template)
+        elif stylefile :
             self.docx.new_document(stylefile)
         else:
             self.docx.new_document('style.docx')
+        if self.builder.config['docx_streaming']:
+            self.docx.start_streaming()
+        self.docx.set_compression(self.builder.config['docx_compression'])
+        self.docx.set_coalesce_runs(self.builder.config['docx_coalesce_runs'])
+        if self.builder.image_infos is not None:
+            self.docx.set_image_infos(self.builder.image_infos)
+        if self.builder.image_resampler is not None:
+            self.docx.set_resampler(self.builder.image_resampler)
+        # a worker of the split output is one of 'docx_parallel' already
+        if not multiprocessing.current_process().daemon:
+            self.docx.set_threads(self.builder.config['docx_parallel'])
 
     def save(self, filename):
         self.docx.set_coverpage(self.coverpage)
@@ -159,9 +174,138 @@ class DocxWriter(writers.Writer):
 
     def translate(self):
         visitor = DocxTranslator(self.document, self.builder, self.docx)
+        # dot runs as many processes as the CPUs, but in a worker of the
+        # split output which is one of 'docx_parallel' already
+        if multiprocessing.current_process().daemon:
+            visitor.rendered_graphs = render_graphs(visitor, 1)
+        else:
+            visitor.rendered_graphs = render_graphs(visitor,
+                                          multiprocessing.cpu_count())
+        processes = self.builder.config['docx_parallel']
+        # read the images ahead, the workers forked below find them too
+        self.docx.image_infos.prefetch(
+                [visitor.get_image_filename(x)
+                 for x in self.document.traverse(nodes.image)] +
+                visitor.rendered_graphs.values())
+        # a worker of the split output can't start a pool of its own
+        if processes > 1 and hasattr(os, 'fork') and \
+               not multiprocessing.current_process().daemon:
+            visitor.prerendered = render_fragments(visitor, processes)
         self.document.walkabout(visitor)
         self.output = ''  # visitor.body
 
+#
+#  Rendering of the graphviz diagrams ahead of translation
+#    render_dot() skips the diagrams whose output file is already there
+#    (named after the code, the options and the format), so the renders
+#    of the previous builds are reused.
+#
+def get_graph_key(node):
+    return node['code'], tuple(node['options'])
+
+def render_graphs(translator, threads):
+    '''
+       Render the graphviz diagrams of the document, 'threads' dot
+       processes at a time.  Return their PNG files keyed by
+       get_graph_key().  A diagram which fails is left to
+       visit_graphviz(), which reports the error.
+    '''
+    graphs = []
+    seen = set()
+    for node in translator.document.traverse(graphviz.graphviz):
+        key = get_graph_key(node)
+        if key not in seen:
+            seen.add(key)
+            graphs.append(key)
+    rendered = {}
+    if not graphs:
+        return rendered
+
+    def render(key):
+        try:
+            fname, outfn = graphviz.render_dot(translator, key[0], list(key[1]), 'png')
+        except Exception:
+            return
+        if outfn is not None:
+            rendered[key] = outfn
+
+    # the first one finds out whether dot can be run at all (and warns once)
+    render(graphs[0])
+    pool = ThreadPool(max(1, threads))
+    try:
+        pool.map(render, graphs[1:], 1)
+    finally:
+        pool.close()
+        pool.join()
+    return rendered
+
+#
+#  Parallel translation of the top-level documents
+#    The workers are forked after the doctree is assembled, so they find
+#    it in '_parallel_context' instead of receiving it pickled.
+#
+_parallel_context = None
+
+def render_fragments(translator, processes):
+    '''
+       Translate the top-level included documents in worker processes,
+       return their fragments keyed by fragment key.
+    '''
+    global _parallel_context
+    sofs = [x for x in translator.document.traverse(addnodes.start_of_file)
+              if not has_ancestor(x, addnodes.start_of_file)]
+    if len(sofs) < 2 :
+        return {}
+
+    _parallel_context = (translator.document, translator.builder, sofs)
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_render_fragment, range(len(sofs)), 1)
+    finally:
+        pool.close()
+        pool.join()
+        _parallel_context = None
+
+    prerendered = {}
+    resampler = translator.builder.image_resampler
+    for result in results:
+        if result is not None:
+            key, fragment, used, images, infos = result
+            translator.fragments.used.update(used)
+            if resampler is not None:
+                resampler.used.update(images)
+            translator.docx.image_infos.update(infos)
+            if fragment is not None:
+                prerendered[key] = fragment
+    return prerendered
+
+def _render_fragment(index):
+    '''
+       Worker: translate one top-level document with its own composer.
+       Return None on failure, the document is then translated serially.
+    '''
+    document, builder, sofs = _parallel_context
+    node = sofs[index]
+    writer = DocxWriter(builder)
+    try:
+        visitor = DocxTranslator(document, builder, writer.docx)
+        # the table of contents precedes the first included document
+        visitor.toc_out = True
+        key = visitor.get_fragment_key(node)
+        if key is None or visitor.fragments.has(key):
+            return key, None, [key], [], {}
+        visitor.fragment_root = node
+        node.walkabout(visitor)
+        images = []
+        if builder.image_resampler is not None:
+            images = list(builder.image_resampler.used)
+        return key, visitor.root_fragment, list(visitor.fragments.used), images, \
+               writer.docx.image_infos.get_changes()
+    except Exception:
+        return None
+    finally:
+        writer.docx.delete_template()
+
 #
 #  DocxTranslator class for sphinx
 #
@@ -200,6 +344,20 @@ class DocxTranslator(nodes.NodeVisitor):
 
         self.option = []
 
+        self.fragments = builder.fragment_cache
+        self.fragment_stack = []
+        self.fragment_root = None
+        self.root_fragment = None
+        self.prerendered = {}
+        self.rendered_graphs = {}
+        # the sections of a file of the split output are bookmarked, the
+        # targets of the links within the file
+        self.bookmarks = set()
+        if builder.config.docx_split:
+            for section in document.traverse(nodes.section):
+                self.bookmarks.update(section['ids'])
+        self.hyperlinks = []
+
     def add_text(self, text):
         '''
 	   Add text in states
@@ -305,8 +463,7 @@ class DocxTranslator(nodes.NodeVisitor):
             # change numbering
             if num_style[0] <  self.max_num_list_id :
                 self.max_num_list_id += 1
-                paras = self.docx.find_numbering_paragraph(num_style[0])
-		num_style[1][0] = len(paras)+1
+		num_style[1][0] = self.docx.count_numbering_paragraph(num_style[0])+1
                 num_style[0] = self.max_num_list_id
 
             self.flush_list_item(num_style[0], start_num=num_style[1][0], 
@@ -359,13 +516,84 @@ class DocxTranslator(nodes.NodeVisitor):
 
 #        self.docx.pagebreak(type='page', orient='portrait')
 
+        key = self.get_fragment_key(node)
+        if key is not None:
+            fragment = self.prerendered.get(key)
+            if fragment is not None:
+                self.fragments.put(key, fragment)
+            else:
+                fragment = self.fragments.get(key)
+            # the fragment may depend on the style of the last paragraph
+            if fragment is not None and (fragment['entry_style'] is None or
+                   fragment['entry_style'] == self.docx.get_last_paragraph_style()):
+                self.fragments.used.update(fragment['children'])
+                if self.fragment_stack:
+                    self.fragment_stack[-1][3].extend(
+                            [key] + fragment['children'])
+                self.splice_fragment(fragment)
+                self.end_state()
+                raise nodes.SkipNode
+            self.docx.begin_fragment(self.max_num_list_id)
+        self.fragment_stack.append(
+                (key, self.max_num_list_id, self.num_list_id, []))
+
     def depart_start_of_file(self, node):
         '''
 	   end of a file
         '''
         dprint()
+        key, max_num_list_id, num_list_id, children = self.fragment_stack.pop()
+        if key is not None:
+            fragment = self.docx.end_fragment()
+            # text left in the states would leak into the next document
+            if not get_items_list(self.states):
+                fragment['num_span'] = self.max_num_list_id - max_num_list_id
+                fragment['num_list_span'] = self.num_list_id - num_list_id
+                fragment['sectionlevel'] = self.sectionlevel
+                fragment['toc_out'] = self.toc_out
+                fragment['children'] = children
+                self.fragments.put(key, fragment)
+                if node is self.fragment_root:
+                    self.root_fragment = fragment
+            if self.fragment_stack:
+                self.fragment_stack[-1][3].extend([key] + children)
         self.end_state()
 
+    def get_fragment_key(self, node):
+        '''
+	   key of the rendered output of an included document, or None
+	   if it can't be cached at the current position.
+        '''
+        if self.fragments is None or self.current_block or \
+               self.list_level or self.block_level or self.line_block_level or \
+               self.table is not None or get_items_list(self.states) or \
+               self.docx.current_docbody is not self.docx.docbody:
+            return None
+
+        images = []
+        for image in node.traverse(nodes.image):
+            file_path = os.path.join(self.builder.env.srcdir, image['uri'])
+            try:
+                images.append((image['uri'], os.path.getmtime(file_path),
+                               os.path.getsize(file_path)))
+            except OSError:
+                images.append((image['uri'], None))
+
+        # whether a reference becomes a link depends on the whole file
+        links = [self.get_link(x) for x in node.traverse(nodes.reference)]
+
+        return self.fragments.make_key(node.pformat(), images, self.toc_out, links)
+
+    def splice_fragment(self, fragment):
+        '''
+	   output a cached document instead of translating it
+        '''
+        self.docx.splice_fragment(fragment, self.max_num_list_id)
+        self.max_num_list_id += fragment['num_span']
+        self.num_list_id += fragment['num_list_span']
+        self.sectionlevel = fragment['sectionlevel']
+        self.toc_out = fragment['toc_out']
+
     def visit_document(self, node):
         '''
 	   start of a document
@@ -445,7 +673,7 @@ class DocxTranslator(nodes.NodeVisitor):
         '''
 	   start of a compound (pass a text)
         '''
-	if self.states[-1][0]  == 'Contents:' :
+	if self.states[-1] and self.states[-1][0]  == 'Contents:' :
 	   self.states.pop()
 	   self.states.append(['  '])
 	  
@@ -496,6 +724,9 @@ class DocxTranslator(nodes.NodeVisitor):
 
         if self.table is not None :
             self.docx.paragraph(text, style='TableHeading')
+        elif isinstance(node.parent, nodes.section) :
+            self.docx.heading(text, self.sectionlevel,
+                    [x for x in node.parent['ids'] if x in self.bookmarks])
         else :
             self.docx.heading(text, self.sectionlevel)
 
@@ -759,6 +990,7 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def depart_option_list(self, node):
         dprint()
+	self.docx.release(self.current_option_list)
 	self.current_option_list = None
         pass
 
@@ -913,12 +1145,14 @@ class DocxTranslator(nodes.NodeVisitor):
         dprint()
         self.flush_state()
         dprint(_func=' image ', uri=node.attributes['uri'])
-        uri = node.attributes['uri']
-        file_path = os.path.join(self.builder.env.srcdir, uri)
+        file_path = self.get_image_filename(node)
         width, height = self.get_image_scaled_width_height(node, file_path)
 
         self.docx.picture(file_path, '',width, height)
 
+    def get_image_filename(self, node):
+        return os.path.join(self.builder.env.srcdir, node.attributes['uri'])
+
     def depart_image(self, node):
         dprint()
 
@@ -962,21 +1196,10 @@ class DocxTranslator(nodes.NodeVisitor):
         return scale
 
     def get_image_scaled_width_height(self, node, filename):
-        dpi = (72, 72)
-
-        if Image is not None :
-            try:
-              imageobj = Image.open(filename, 'r')
-            except:
-              raise RuntimeError('Fail to open image file: %s' % filename)
-
-            dpi = imageobj.info.get('dpi', dpi)
-            # dpi information can be (xdpi, ydpi) or xydpi
-            try: iter(dpi)
-            except: dpi = (dpi, dpi)
-        else:
-            imageobj = None
-            raise RuntimeError('image size not fully specified and PIL not installed')
+        # read from the header of the file, or by PIL
+        size_x, size_y, dpi = self.docx.image_infos.get(filename)
+        if dpi is None:
+            dpi = (72, 72)
 
         scale = self.get_image_scale(node)
         width = self.get_image_width_height(node, 'width')
@@ -989,27 +1212,24 @@ class DocxTranslator(nodes.NodeVisitor):
            height = [int(self.docx.styleDocx.document_height * height[0] * 0.00284 ), 'px']
 
         if width is None or height is None:
-            if imageobj is None:
-                raise RuntimeError(
-                    'image size not fully specified and PIL not installed')
             if width is None:
                 if height is None:
-                     width = [imageobj.size[0], 'px']
-                     height = [imageobj.size[1], 'px']
+                     width = [size_x, 'px']
+                     height = [size_y, 'px']
                 else:
-                     scaled_width = imageobj.size[0] * height[0] /imageobj.size[1]
+                     scaled_width = size_x * height[0] /size_y
                      width = [scaled_width, 'px']
             else:
                 if height is None:
-                     scaled_height = imageobj.size[1] * width[0] / imageobj.size[0]
+                     scaled_height = size_y * width[0] / size_x
                      height = [scaled_height, 'px']
                 else:
-                     height = [imageobj.size[1], 'px']
+                     height = [size_y, 'px']
 
         width[0] *= scale
         height[0] *= scale
-        if width[1] == 'in': width = [width[0] * dip[0], 'px']
-        if height[1] == 'in': height = [height[0] *dip[1], 'px']
+        if width[1] == 'in': width = [width[0] * dpi[0], 'px']
+        if height[1] == 'in': height = [height[0] *dpi[1], 'px']
 
         #  We shoule shulink image (multiply 72/96)
         width[0] *= 0.75
@@ -1167,6 +1387,7 @@ class DocxTranslator(nodes.NodeVisitor):
         pass
 
     def depart_field_list(self, node):
+        self.docx.release(self.current_field_list)
         self.current_field_list = None
         dprint()
         pass
@@ -1385,13 +1606,43 @@ class DocxTranslator(nodes.NodeVisitor):
         dprint()
         pass
 
+    def get_link(self, node):
+        '''
+           The target of a reference of the split output: another file, or
+           '#anchor' for a section of this file (Sphinx refers to those
+           by 'refid', or by a 'refuri' relative to this file: '#anchor').
+        '''
+        uri, sep, anchor = node.get('refuri', '').partition('#')
+        if 'refid' in node:
+            uri, anchor = '', node['refid']
+        if not uri:
+            if anchor in self.bookmarks:
+                return '#' + anchor
+        elif uri.endswith(self.builder.out_suffix) and '://' not in uri:
+            return uri
+        return None
+
     def visit_reference(self, node):
         dprint()
-        pass
+        # references to the other files of the split output, and to the
+        # sections of this file, become links
+        uri = self.get_link(node)
+        if uri is not None:
+            self.hyperlinks.append((uri, len(self.states), len(self.states[-1])))
+        else:
+            self.hyperlinks.append(None)
 
     def depart_reference(self, node):
         dprint()
-        pass
+        link = self.hyperlinks.pop()
+        if link is not None and link[1] == len(self.states):
+            uri, depth, start = link
+            texts = self.states[-1]
+            for i in range(start, len(texts)):
+                if isinstance(texts[i], list):
+                    texts[i] = [texts[i][0], texts[i][1], uri]
+                else:
+                    texts[i] = [texts[i], 'Hyperlink', uri]
 
     def visit_download_reference(self, node):
         dprint()
@@ -1533,7 +1784,9 @@ class DocxTranslator(nodes.NodeVisitor):
 
     def visit_graphviz(self, node):
         dprint()
-	fname, filename = graphviz.render_dot(self, node['code'], node['options'],'png')
+        filename = self.rendered_graphs.get(get_graph_key(node))
+        if filename is None:
+            fname, filename = graphviz.render_dot(self, node['code'], node['options'],'png')
         self.flush_state()
         width, height = self.get_image_scaled_width_height(node, filename)
         self.docx.picture(filename, '',width, height)